@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+import nonebot
+
+
+group_amount = 2000
+user_amount = 20
+history_amount = 200
+changed_group_amount = 50
+
+
+async def populate(database):
+    for group_id in range(1, group_amount + 1):
+        await database.register_group_setting(group_id)
+        group_setting = await database.get_group_setting(group_id)
+        for user_id in random.sample(range(1, group_amount * 5), user_amount):
+            await group_setting.register_user_setting(user_id, f'user_{user_id}')
+        for i in range(history_amount):
+            await group_setting.add_history(f'https://twitter.com/user/status/{i}')
+
+
+async def change_some_groups(database):
+    # a typical autosave only sees a handful of modified users and new history entries
+    for group_id in random.sample(list(database.group_settings), changed_group_amount):
+        group_setting = await database.get_group_setting(group_id)
+        user_id = random.choice(list(group_setting.user_settings))
+        await group_setting.modify_user_setting('receive_retweet', False, user_id=user_id)
+        await group_setting.add_history(f'https://twitter.com/user/status/{group_id}')
+
+
+async def load_all_history(database):
+    for group_setting in database.group_settings.values():
+        await group_setting.load_history()
+
+
+async def measure(name: str, coroutine):
+    started_at = time.perf_counter()
+    result = await coroutine
+    print(f'{name:<32}{time.perf_counter() - started_at:>10.3f}s')
+    return result
+
+
+def check_loaded(database):
+    # an empty load would make every number above meaningless
+    assert len(database.group_settings) == group_amount, f'{database} loaded {len(database.group_settings)} groups'
+    assert len(database.subscription_index.user_groups) != 0, f'{database} loaded no subscriptions'
+
+
+async def run(module):
+    json_database = module.Database()
+    await populate(json_database)
+    await measure('json full save', json_database.save())
+    json_database = module.Database()
+    await measure('json load', json_database.load())
+    check_loaded(json_database)
+    await measure('json load all history', load_all_history(json_database))
+    await change_some_groups(json_database)
+    await measure('json incremental save', json_database.save())
+
+    sqlite_database = module.SqliteDatabase()
+    await measure('sqlite migrate + load', sqlite_database.load())
+    await sqlite_database.shutdown()
+    sqlite_database = module.SqliteDatabase()
+    await measure('sqlite load', sqlite_database.load())
+    check_loaded(sqlite_database)
+    await measure('sqlite load all history', load_all_history(sqlite_database))
+    await change_some_groups(sqlite_database)
+    await measure('sqlite incremental save', sqlite_database.save())
+    await sqlite_database.shutdown()
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with tempfile.TemporaryDirectory() as temp_path:
+        database_path = os.path.join(temp_path, 'database')
+        os.mkdir(database_path)
+        nonebot.init(database_path=database_path,
+                     database_sqlite_path=os.path.join(temp_path, 'database.sqlite3'))
+        plugin = nonebot.load_plugin('src.plugins.database')
+        asyncio.run(run(plugin.module))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import random
+import timeit
+
+from types import SimpleNamespace
+
+
+follow_amount = 5000
+group_amount = 300
+status_amount = 10000
+
+
+def make_follow_list():
+    # mirrors the old run_stream output, one entry per (group, user) pair
+    users = [random.randint(10 ** 8, 10 ** 18) for _ in range(follow_amount)]
+    follow_list = list()
+    for _ in range(group_amount):
+        follow_list.extend(random.sample(users, 50))
+    follow_list.extend(users)
+    return users, follow_list
+
+
+def make_statuses(users: list[int]):
+    statuses = list()
+    for _ in range(status_amount):
+        if random.random() < 0.2:
+            user_id = random.choice(users)
+        else:
+            user_id = random.randint(10 ** 8, 10 ** 18)
+        statuses.append(SimpleNamespace(user=SimpleNamespace(id=user_id)))
+    return statuses
+
+
+def main():
+    users, follow_list = make_follow_list()
+    follow_set = frozenset(follow_list)
+    statuses = make_statuses(users)
+    list_time = timeit.timeit(
+        lambda: [status.user.id in follow_list for status in statuses], number=1)
+    set_time = timeit.timeit(
+        lambda: [status.user.id in follow_set for status in statuses], number=5) / 5
+    print(f'follow list: {len(follow_list)} entries, follow set: {len(follow_set)} entries')
+    print(f'list membership: {list_time / status_amount * 10 ** 6:.3f} us/status')
+    print(f'set membership:  {set_time / status_amount * 10 ** 6:.3f} us/status')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os
+import asyncio
+import tempfile
+import tracemalloc
+import nonebot
+
+
+user_setting_amount = 50000
+group_amount = 5000
+tweet_amount = 500
+
+
+class LegacyUserSetting:
+    # the dict backed representation used before settings were slotted
+    receive_tweet: bool = True
+    receive_retweet: bool = True
+    receive_comment: bool = True
+    receive_text: bool = True
+    receive_screenshot: bool = True
+    receive_translation: bool = True
+    receive_content: bool = True
+    receive_collapsed_message: bool = False
+    custom_tag = None
+    custom_background = None
+    custom_css = None
+
+    def __init__(self, user_id: int = -1, screen_name: str = '') -> None:
+        self.user_id = user_id
+        self.screen_name = screen_name
+
+    @staticmethod
+    def from_json(json_content: dict):
+        user_setting = LegacyUserSetting()
+        for key, value in json_content.items():
+            setattr(user_setting, key, value)
+        return user_setting
+
+
+class LegacyGroupSetting:
+    # the dict backed representation used before groups were slotted, with the same fields as today
+    def __init__(self, group_id: int, database_path: str, subscription_index=None) -> None:
+        self.group_id = group_id
+        self.group_database_path = os.path.join(database_path, str(group_id))
+        self.subscription_index = subscription_index
+        self.user_settings = dict()
+        self.screen_names = dict()
+        self.history = None
+        self.history_loader = None
+        self.history_lock = asyncio.Lock()
+        self.user_settings_dirty = False
+        self.changed_user_ids = set()
+
+
+class LegacyTweet:
+    def __init__(self, tweet_id: int, user_id: int, user_screen_name: str, tweet_type: str, text: str, media_urls: list[str]) -> None:
+        self.tweet_id = tweet_id
+        self.original_id = tweet_id
+        self.user_id = user_id
+        self.user_screen_name = user_screen_name
+        self.tweet_url = f'https://twitter.com/{user_screen_name}/status/{tweet_id}'
+        self.tweet_type = tweet_type
+        self.text = text
+        self.media_urls = media_urls
+        self.components = dict()
+
+
+def make_user_setting_json(user_id: int):
+    # settings saved by the old to_json only carried the modified keys
+    return {'user_id': user_id, 'screen_name': f'user_{user_id}', 'receive_retweet': False, 'receive_translation': False}
+
+
+def make_tweet_args(tweet_id: int):
+    return (tweet_id, tweet_id % 1000, f'user_{tweet_id % 1000}', 'tweet', 'text ' * 40,
+            [f'https://pbs.twimg.com/media/{tweet_id}_{i}.jpg' for i in range(2)])
+
+
+async def measure(name: str, factory, amount: int):
+    tracemalloc.start()
+    objects = [await factory(i) for i in range(amount)]
+    (current, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    print(f'{name:<32}{current / amount:>10.1f} bytes per object')
+    return current
+
+
+async def run(database_models, twitter_models):
+    async def legacy_user_setting(i: int):
+        return LegacyUserSetting.from_json(make_user_setting_json(i))
+
+    async def user_setting(i: int):
+        return await database_models.UserSetting.from_json(make_user_setting_json(i))
+
+    async def legacy_group_setting(i: int):
+        return LegacyGroupSetting(i, 'database')
+
+    async def group_setting(i: int):
+        return database_models.GroupSetting(i, 'database')
+
+    async def legacy_tweet(i: int):
+        return LegacyTweet(*make_tweet_args(i))
+
+    async def tweet(i: int):
+        return twitter_models.Tweet(*make_tweet_args(i))
+
+    for (name, legacy_factory, factory, amount) in [('user setting', legacy_user_setting, user_setting, user_setting_amount),
+                                                    ('group setting', legacy_group_setting, group_setting, group_amount),
+                                                    ('tweet', legacy_tweet, tweet, tweet_amount)]:
+        before = await measure(f'legacy {name}', legacy_factory, amount)
+        after = await measure(f'slotted {name}', factory, amount)
+        print(f'{name + " saved":<32}{(before - after) / amount:>10.1f} bytes per object ({1 - after / before:.0%})')
+
+
+def main():
+    root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as temp_path:
+        # require() resolves sibling plugins through the plugin dir, nothing is started while loading
+        nonebot.init(database_path=temp_path, cq_http_path=temp_path, server_path=temp_path,
+                     server_url='http://127.0.0.1:1')
+        nonebot.load_plugins(os.path.join(root_path, 'src', 'plugins'))
+        asyncio.run(run(nonebot.get_plugin('database').module.models, nonebot.get_plugin('twitter').module.models))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,74 @@
+import time
+import asyncio
 import nonebot
 
 from nonebot.plugin import require
 
-from .twitter import StreamHolder
+from .twitter import StreamHolder, Translator, RenderQueue
 from .external import ExternalHolder
 from .database import Database
+from .network import SessionPool
+from .send import SendScheduler
 
 
 database_dict = require('database')
 database: Database = database_dict.database
 twitter_dict = require('twitter')
 stream_holder: StreamHolder = twitter_dict.stream_holder
+translator: Translator = twitter_dict.translator
+render_queue: RenderQueue = twitter_dict.render_queue
 external_dict = require('external')
 external_holder: ExternalHolder = external_dict.external_holder
+network_dict = require('network')
+session_pool: SessionPool = network_dict.session_pool
+send_dict = require('send')
+send_scheduler: SendScheduler = send_dict.send_scheduler
+
+
+async def run_phase(name: str, coroutine):
+    started_at = time.perf_counter()
+    await coroutine
+    nonebot.logger.debug(
+        f'startup phase {name} completed in {time.perf_counter() - started_at:.3f}s')
 
 
 @nonebot.get_driver().on_startup
 async def startup():
-    await database.load()
-    await external_holder.startup()
+    await run_phase('session pool', session_pool.startup())
+    await run_phase('stream holder', stream_holder.load())
+    # the stream connects as soon as the subscription index is built, the rest keeps loading meanwhile
+    stream_task = asyncio.create_task(run_phase('stream', stream_holder.startup()))
+    await run_phase('database', database.load())
+    database.start_autosave()
+    await run_phase('translator', translator.load())
+    await run_phase('send scheduler', send_scheduler.load())
+    await run_phase('external', external_holder.startup())
+    await stream_task
     nonebot.logger.debug('startup completed')
 
 
 @nonebot.get_driver().on_shutdown
 async def shutdown():
-    await database.save()
+    # the stream and its deliveries stop first, the final save must see every history id they took
     await stream_holder.shutdown()
+    await database.shutdown()
+    nonebot.logger.debug(f'translation stats {translator}')
+    await translator.shutdown()
+    nonebot.logger.debug(f'render stats {render_queue}')
     await external_holder.shutdown()
+    await session_pool.shutdown()
     nonebot.logger.debug('shutdown completed')
 
 
 @nonebot.get_driver().on_bot_connect
 async def bot_connect(bot):
+    send_scheduler.resume(bot)
     await stream_holder.startup()
+    # replayed tweets wait for the bot, queued during startup they would block it
+    await stream_holder.replay()
 
 
 @nonebot.get_driver().on_bot_disconnect
 async def bot_disconnect(bot):
-    await external_holder.reboot_cq_http()
+    send_scheduler.pause()
+    await external_holder.check_cq_http()
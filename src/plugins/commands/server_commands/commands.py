@@ -1,5 +1,4 @@
 import nonebot
-import aiohttp
 from nonebot.adapters.cqhttp.message import MessageSegment
 
 from nonebot.plugin import require, on_command
@@ -8,10 +7,13 @@ from nonebot.adapters.cqhttp import Bot, GroupMessageEvent
 
 from ..utils import get_group_setting
 from ...database import Database, GroupSetting, UserSetting
+from ...network import SessionPool
 
 
 database_dict = require('database')
 database: Database = database_dict.database
+network_dict = require('network')
+session_pool: SessionPool = network_dict.session_pool
 
 
 translate_command = on_command('translate', aliases=set(['tr']))
@@ -28,12 +30,17 @@ async def translate_handler(bot: Bot, event: GroupMessageEvent, state: T_State):
         await translate_command.finish(f'非法参数类型，需要：int，当前：{index}')
     group_setting = await get_group_setting(translate_command, database, event.group_id)
     match await group_setting.get_history(int(index)):
-        case[True, history]:
-            screen_name = history.split('/')[3]
-            user_setting = await group_setting.get_user_setting(screen_name=screen_name)
+        case[True, (url, user_id)]:
+            if user_id is None:
+                # entries migrated from history.txt only carry the url
+                screen_name = url.split('/')[3]
+                user_setting = await group_setting.get_user_setting(screen_name=screen_name)
+            else:
+                screen_name = database.subscription_index.get_screen_name(user_id) or url.split('/')[3]
+                user_setting = await group_setting.get_user_setting(user_id=user_id)
             if user_setting is None:
                 await translate_command.finish(f'未注册用户{screen_name}')
-            state['url'] = history
+            state['url'] = url
             state['user_setting'] = user_setting
             state['group_setting'] = group_setting
         case[False, message]:
@@ -66,15 +73,14 @@ async def translation_handler(bot: Bot, event: GroupMessageEvent, state: T_State
         request_payload['custom']['css'] = f'{group_setting.group_database_path}\\{user_setting.custom_css}'
     if user_setting.custom_background is not None:
         request_payload['custom']['background'] = f'{group_setting.group_database_path}\\{user_setting.custom_background}'
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f'{server_url}/translate', json=request_payload) as response:
-            if response.status != 200:
-                await translate_command.finish(f'服务端未知错误{response.status}，请联系管理员')
-            server_response: str = await response.json(encoding='utf-8')
-            match server_response:
-                case {'type': 'err', 'message': err_message}:
-                    await translate_command.finish(err_message)
-                case {'type': 'ok', 'screenshotPath': screenshot_path}:
-                    await translate_command.finish(MessageSegment.image(file=f'file:///{server_path}\\{screenshot_path}'))
-                case _:
-                    await translate_command.finish(f'服务器未知错误，请联系管理员')
+    async with session_pool.get('server_translate', f'{server_url}/translate', json=request_payload) as response:
+        if response.status != 200:
+            await translate_command.finish(f'服务端未知错误{response.status}，请联系管理员')
+        server_response: str = await response.json(encoding='utf-8')
+    match server_response:
+        case {'type': 'err', 'message': err_message}:
+            await translate_command.finish(err_message)
+        case {'type': 'ok', 'screenshotPath': screenshot_path}:
+            await translate_command.finish(MessageSegment.image(file=f'file:///{server_path}\\{screenshot_path}'))
+        case _:
+            await translate_command.finish(f'服务器未知错误，请联系管理员')
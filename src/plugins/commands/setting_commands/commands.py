@@ -107,8 +107,10 @@ async def custom_content_handler(bot: Bot, event: GroupMessageEvent, state: T_St
     if screen_name == '*':
         for user_setting in group_setting.user_settings.values():
             setattr(user_setting, f'custom_{key}', file_name)
+        group_setting.mark_dirty()
     else:
         setattr(user_setting, f'custom_{key}', file_name)
+        group_setting.mark_dirty(user_setting.user_id)
     await custom_user_setting_command.finish('设置完成')
 
 
@@ -1,13 +1,18 @@
-import aiohttp
 import aiofiles
 
 from typing import Type
+from nonebot.plugin import require
 from nonebot.adapters.cqhttp.message import MessageSegment
 from nonebot.matcher import Matcher
 from nonebot.adapters.cqhttp import GroupMessageEvent
 
 from ..utils import get_group_setting
 from ...database import Database, custom_types
+from ...network import SessionPool
+
+
+network_dict = require('network')
+session_pool: SessionPool = network_dict.session_pool
 
 
 async def modify_user_setting(matcher: Type[Matcher], event: GroupMessageEvent, database: Database, value: bool):
@@ -25,10 +30,9 @@ async def modify_user_setting(matcher: Type[Matcher], event: GroupMessageEvent,
 
 
 async def save_image_to_disk(url: str, path: str):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                return False
-            async with aiofiles.open(path, 'wb') as f:
-                await f.write(await response.read())
-            return True
+    async with session_pool.get('image', url) as response:
+        if response.status != 200:
+            return False
+        async with aiofiles.open(path, 'wb') as f:
+            await f.write(await response.read())
+        return True
@@ -1,3 +1,5 @@
+import re
+
 from nonebot.plugin import require, on_command
 from nonebot.typing import T_State
 from nonebot.adapters.cqhttp import Bot, GroupMessageEvent
@@ -12,39 +14,62 @@ stream_holder: StreamHolder = twitter_dict.stream_holder
 database_dict = require('database')
 database: Database = database_dict.database
 
+
+async def get_screen_names(event: GroupMessageEvent):
+    return [screen_name for screen_name in re.split(r'[\s,，;；]+', str(event.get_message()).strip()) if screen_name != '']
+
+
 add_twitter_user_command = on_command('add')
 add_twitter_user_command.__doc__ = """add: 在当前群订阅推特用户，eg: #add <screen name>，screen name可以在推特链接中找到，
-（eg: https://twitter.com/TAKATOSHI_Gship， 则screen name为 TAKATOSHI_Gship，对应的命令为#add TAKATOSHI_Gship）"""
+（eg: https://twitter.com/TAKATOSHI_Gship， 则screen name为 TAKATOSHI_Gship，对应的命令为#add TAKATOSHI_Gship），
+可以一次订阅多个用户，用空格或逗号分隔，eg: #add TAKATOSHI_Gship KanColle_STAFF"""
 
 
 @add_twitter_user_command.handle()
 async def add_twitter_user_handler(bot: Bot, event: GroupMessageEvent, state: T_State):
-    screen_name = str(event.get_message()).strip()
+    screen_names = await get_screen_names(event)
+    if len(screen_names) == 0:
+        await add_twitter_user_command.finish('需要指定screen_name')
     group_setting = await get_group_setting(add_twitter_user_command, database, event.group_id)
-    match await stream_holder.client_get_user(screen_name):
-        case[True, user]:
-            (flag, message) = await group_setting.register_user_setting(user.id, screen_name)
-            if flag:
-                await stream_holder.run_stream()
-            await add_twitter_user_command.finish(message)
-        case _:
-            await add_twitter_user_command.finish('获取用户失败，请检查screen_name是否正确')
+    users = await stream_holder.client_get_users(screen_names)
+    changed = False
+    messages = list()
+    for screen_name in screen_names:
+        user = users.get(screen_name.lower())
+        if user is None:
+            messages.append(f'获取用户{screen_name}失败，请检查screen_name是否正确')
+            continue
+        (flag, message) = await group_setting.register_user_setting(user.id, user.screen_name)
+        changed = changed or flag
+        messages.append(message)
+    if changed:
+        await stream_holder.resubscribe()
+    await add_twitter_user_command.finish('\n'.join(messages))
 
 
 delete_twitter_user_command = on_command('delete')
 delete_twitter_user_command.__doc__ = """delete: 在当前群删除订阅的推特用户,eg: #delete <screen name>，screen name可以在推特链接中找到，
-（eg: https://twitter.com/TAKATOSHI_Gship， 则screen name为 TAKATOSHI_Gship，对应的命令为#delete TAKATOSHI_Gship）"""
+（eg: https://twitter.com/TAKATOSHI_Gship， 则screen name为 TAKATOSHI_Gship，对应的命令为#delete TAKATOSHI_Gship），
+可以一次删除多个用户，用空格或逗号分隔"""
 
 
 @delete_twitter_user_command.handle()
 async def delete_twitter_user_handler(bot: Bot, event: GroupMessageEvent, state: T_State):
-    screen_name = str(event.get_message()).strip()
-    group_setting = await get_group_setting(add_twitter_user_command, database, event.group_id)
-    match await stream_holder.client_get_user(screen_name):
-        case[True, user]:
-            (flag, message) = await group_setting.unregister_user_setting(user.id, screen_name)
-            if flag:
-                await stream_holder.run_stream()
-            await add_twitter_user_command.finish(message)
-        case _:
-            await add_twitter_user_command.finish('获取用户失败，请检查screen_name是否正确')
+    screen_names = await get_screen_names(event)
+    if len(screen_names) == 0:
+        await delete_twitter_user_command.finish('需要指定screen_name')
+    group_setting = await get_group_setting(delete_twitter_user_command, database, event.group_id)
+    users = await stream_holder.client_get_users(screen_names)
+    changed = False
+    messages = list()
+    for screen_name in screen_names:
+        user = users.get(screen_name.lower())
+        if user is None:
+            messages.append(f'获取用户{screen_name}失败，请检查screen_name是否正确')
+            continue
+        (flag, message) = await group_setting.unregister_user_setting(user.id, user.screen_name)
+        changed = changed or flag
+        messages.append(message)
+    if changed:
+        await stream_holder.resubscribe()
+    await delete_twitter_user_command.finish('\n'.join(messages))
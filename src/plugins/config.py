@@ -0,0 +1,7 @@
+import nonebot
+
+
+def get_config(name: str, default=None):
+    # nonebot's Config answers None for unset keys instead of raising, so getattr never falls back to its default
+    value = getattr(nonebot.get_driver().config, name, None)
+    return default if value is None else value
@@ -1,8 +1,15 @@
+import nonebot
+
 from nonebot.plugin import export
 
 from .models import UserSetting, GroupSetting, custom_types
-from .datasource import Database
+from .datasource import Database, SubscriptionIndex
+from .sqlite_datasource import SqliteDatabase
+from ..config import get_config
 
 
 database_dict = export()
-database_dict.database = Database()
+if get_config('database_backend', 'json') == 'sqlite':
+    database_dict.database = SqliteDatabase()
+else:
+    database_dict.database = Database()
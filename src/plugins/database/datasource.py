@@ -1,34 +1,177 @@
 import os
+import time
+import asyncio
 import nonebot
 
-from .models import GroupSetting, UserSetting
+from asyncio import Task
+
+from .models import GroupSetting
+from ..config import get_config
+
+
+class SubscriptionIndex:
+    user_groups: dict[int, set[int]]
+    user_screen_names: dict[int, str]
+    registered_users: frozenset[int] = None
+
+    def __init__(self) -> None:
+        self.user_groups = dict()
+        self.user_screen_names = dict()
+
+    def add(self, user_id: int, group_id: int, screen_name: str = None):
+        group_ids = self.user_groups.get(user_id)
+        if group_ids is None:
+            group_ids = self.user_groups[user_id] = set()
+            self.registered_users = None
+        group_ids.add(group_id)
+        if screen_name is not None:
+            self.set_screen_name(user_id, screen_name)
+
+    def set_screen_name(self, user_id: int, screen_name: str):
+        self.user_screen_names[user_id] = screen_name
+
+    def discard(self, user_id: int, group_id: int):
+        group_ids = self.user_groups.get(user_id)
+        if group_ids is None:
+            return
+        group_ids.discard(group_id)
+        if len(group_ids) == 0:
+            self.user_groups.pop(user_id)
+            self.registered_users = None
+            self.user_screen_names.pop(user_id, None)
+
+    def add_group(self, group_setting: GroupSetting):
+        for user_setting in group_setting.user_settings.values():
+            self.add(user_setting.user_id, group_setting.group_id, user_setting.screen_name)
+
+    def discard_group(self, group_setting: GroupSetting):
+        for user_id in group_setting.user_settings:
+            self.discard(user_id, group_setting.group_id)
+
+    def get_groups(self, user_id: int):
+        return self.user_groups.get(user_id, set())
+
+    def get_screen_name(self, user_id: int):
+        return self.user_screen_names.get(user_id)
+
+    def get_users(self):
+        if self.registered_users is None:
+            self.registered_users = frozenset(self.user_groups)
+        return self.registered_users
 
 
 class Database:
     database_path: str
     group_settings: dict[int, GroupSetting]
+    subscription_index: SubscriptionIndex
+    autosave_interval: float
+    autosave_task: Task = None
+    save_lock: asyncio.Lock
+    ready: asyncio.Event
+    loaded: asyncio.Event
 
     def __init__(self) -> None:
-        self.database_path = nonebot.get_driver().config.database_path
+        config = nonebot.get_driver().config
+        self.database_path = config.database_path
+        self.autosave_interval = float(
+            get_config('database_autosave_interval', 60))
+        self.load_concurrency = int(
+            get_config('database_load_concurrency', 16))
         self.group_settings = dict()
+        self.subscription_index = SubscriptionIndex()
+        self.save_lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        self.loaded = asyncio.Event()
 
     async def load(self):
         nonebot.logger.debug(f'{self} => load started')
-        group_databases = os.listdir(self.database_path)
-        for group_database in group_databases:
-            if not group_database.isdigit():
-                continue
-            group_setting = GroupSetting(
-                int(group_database), self.database_path)
-            await group_setting.load()
+        started_at = time.perf_counter()
+        subscriptions = await self.load_subscriptions()
+        if subscriptions is not None:
+            for (group_id, user_id, screen_name) in subscriptions:
+                self.subscription_index.add(user_id, group_id, screen_name)
+            # the stream only needs the index, it connects while the settings are parsed
+            self.ready.set()
+        indexed_at = time.perf_counter()
+        group_settings = await self.load_group_settings()
+        for group_setting in group_settings:
             self.group_settings[group_setting.group_id] = group_setting
-        nonebot.logger.debug(f'{self} => load completed')
+            if subscriptions is None:
+                self.subscription_index.add_group(group_setting)
+        self.ready.set()
+        self.loaded.set()
+        nonebot.logger.debug(
+            f'{self} => load completed, index built in {indexed_at - started_at:.3f}s, '
+            f'groups loaded in {time.perf_counter() - indexed_at:.3f}s')
+
+    async def wait_ready(self):
+        await self.ready.wait()
+
+    async def wait_loaded(self):
+        await self.loaded.wait()
+
+    async def load_subscriptions(self) -> list[tuple[int, int, str]] | None:
+        # the subscriptions are only known from user.json, the index is built from the loaded groups
+        return None
+
+    async def load_group_settings(self):
+        started_at = time.perf_counter()
+        group_databases = await asyncio.to_thread(os.listdir, self.database_path)
+        nonebot.logger.debug(
+            f'{self} => listed {len(group_databases)} entries in {time.perf_counter() - started_at:.3f}s')
+        semaphore = asyncio.Semaphore(self.load_concurrency)
+
+        async def load_group_setting(group_id: int):
+            group_setting = GroupSetting(
+                group_id, self.database_path, self.subscription_index)
+            async with semaphore:
+                await group_setting.load()
+            return group_setting
+
+        return await asyncio.gather(*[load_group_setting(int(group_database))
+                                      for group_database in group_databases if group_database.isdigit()])
 
     async def save(self):
-        nonebot.logger.debug(f'{self} => save started')
-        for group_setting in self.group_settings.values():
-            await group_setting.save()
-        nonebot.logger.debug(f'{self} => save completed')
+        async with self.save_lock:
+            dirty_group_settings = [group_setting for group_setting in self.group_settings.values()
+                                    if group_setting.is_dirty()]
+            if len(dirty_group_settings) == 0:
+                return
+            nonebot.logger.debug(
+                f'{self} => save started, {len(dirty_group_settings)} groups changed')
+            await self.save_group_settings(dirty_group_settings)
+            nonebot.logger.debug(f'{self} => save completed')
+
+    async def save_group_settings(self, group_settings: list[GroupSetting]):
+        # one group failing, e.g. user.json held open on windows, must not keep the others from saving
+        errors = list()
+        for group_setting in group_settings:
+            try:
+                await group_setting.save()
+            except Exception as e:
+                nonebot.logger.warning(
+                    f'{self} => save {group_setting} failed {type(e).__name__} => {e}')
+                errors.append(e)
+        if len(errors) != 0:
+            raise errors[0]
+
+    def start_autosave(self):
+        if self.autosave_task is None or self.autosave_task.done():
+            self.autosave_task = asyncio.create_task(self.run_autosave())
+
+    async def run_autosave(self):
+        while True:
+            await asyncio.sleep(self.autosave_interval)
+            try:
+                await self.save()
+            except Exception as e:
+                nonebot.logger.warning(
+                    f'{self} => autosave failed {type(e).__name__} => {e}')
+
+    async def shutdown(self):
+        if self.autosave_task is not None:
+            self.autosave_task.cancel()
+        await self.save()
 
     async def get_group_setting(self, group_id: int):
         return self.group_settings.get(group_id)
@@ -37,20 +180,42 @@ class Database:
         if group_id in self.group_settings:
             return self.__err(f'已存在群{group_id}')
         self.group_settings[group_id] = GroupSetting(
-            group_id, self.database_path)
+            group_id, self.database_path, self.subscription_index)
+        self.group_settings[group_id].mark_dirty()
         return self.__ok(f'注册群{group_id}成功')
 
     async def unregister_group_setting(self, group_id: int):
         if group_id not in self.group_settings:
             return self.__err(f'不存在群{group_id}')
-        self.group_settings.pop(group_id)
+        group_setting = self.group_settings.pop(group_id)
+        self.subscription_index.discard_group(group_setting)
         return self.__ok(f'删除群{group_id}成功')
 
     async def get_group_registered_for_user(self, user_id: int):
-        return [group_setting for group_setting in self.group_settings.values() if user_id in group_setting.user_settings]
+        return [self.group_settings[group_id] for group_id in self.subscription_index.get_groups(user_id) if group_id in self.group_settings]
+
+    async def rename_user(self, user_id: int, screen_name: str):
+        # twitter users may change their screen name at any time, the stream reports the current one
+        current_screen_name = self.subscription_index.get_screen_name(user_id)
+        if current_screen_name is None or current_screen_name == screen_name:
+            return
+        self.subscription_index.set_screen_name(user_id, screen_name)
+        for group_setting in await self.get_group_registered_for_user(user_id):
+            await group_setting.rename_user_setting(user_id, screen_name)
+        nonebot.logger.debug(
+            f'{self} => user {user_id} renamed from {current_screen_name} to {screen_name}')
+
+    async def get_registered_users(self) -> frozenset[int]:
+        return self.subscription_index.get_users()
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {len(self.group_settings)}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+    def __ok(self, message: str):
+        return True, f'{self} => {message}'
 
-    async def get_all_user_settings(self) -> list[UserSetting]:
-        user_settings = list()
-        for group_setting in self.group_settings.values():
-            user_settings.extend(group_setting.user_settings.values())
-        return user_settings
+    def __err(self, message: str):
+        return False, f'{self} => {message}'
@@ -0,0 +1,64 @@
+from collections import deque
+
+
+class History:
+    capacity: int
+    entries: deque[tuple[str, int | None]]
+    next_id: int = 1
+    unsaved: list[tuple[int, str, int | None]]
+    saved_amount: int = 0
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.entries = deque(maxlen=capacity)
+        self.unsaved = list()
+
+    @property
+    def first_id(self):
+        return self.next_id - len(self.entries)
+
+    @property
+    def last_id(self):
+        return self.next_id - 1
+
+    def append(self, url: str, user_id: int = None):
+        history_id = self.next_id
+        self.entries.append((url, user_id))
+        self.unsaved.append((history_id, url, user_id))
+        self.next_id += 1
+        return history_id
+
+    def get(self, history_id: int):
+        if history_id < self.first_id or history_id > self.last_id:
+            return None
+        return self.entries[history_id - self.first_id]
+
+    def restore(self, records: list[tuple[int, str, int | None]]):
+        # ids must be increasing, later records win over earlier ones with the same id
+        entries = {history_id: (url, user_id) for (history_id, url, user_id) in records}
+        for (history_id, entry) in sorted(entries.items()):
+            if history_id < self.next_id:
+                continue
+            if history_id != self.next_id:
+                self.entries.clear()
+            self.entries.append(entry)
+            self.next_id = history_id + 1
+        self.saved_amount = len(records)
+
+    def mark_all_unsaved(self):
+        self.unsaved = self.get_records()
+
+    def take_unsaved(self):
+        unsaved = self.unsaved
+        self.unsaved = list()
+        return unsaved
+
+    def restore_unsaved(self, records: list[tuple[int, str, int | None]]):
+        # records taken by a failed save go back in front of the ones added since
+        self.unsaved = records + self.unsaved
+
+    def get_records(self):
+        return [(self.first_id + i, url, user_id) for (i, (url, user_id)) in enumerate(self.entries)]
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -1,11 +1,14 @@
 import os
 import json
+import asyncio
 import aiofiles
 import nonebot
 
 from typing import Any, Optional
 from aiofiles.os import mkdir
 
+from .history import History
+
 
 max_history_amount = 1000
 custom_types = {
@@ -15,35 +18,89 @@ custom_types = {
 }
 
 
+async def atomic_write(path: str, content: str):
+    temp_path = f'{path}.tmp'
+    async with aiofiles.open(temp_path, 'w', encoding='utf-8') as f:
+        await f.write(content)
+        await f.flush()
+        await asyncio.to_thread(os.fsync, f.fileno())
+    os.replace(temp_path, path)
+
+
+def format_history_record(record: tuple[int, str, int | None]):
+    (history_id, url, user_id) = record
+    return f'{history_id}\t{url}\t{"" if user_id is None else user_id}\n'
+
+
+class ReceiveFlag:
+    bit: int
+    name: str
+
+    def __init__(self, bit: int) -> None:
+        self.bit = bit
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance.receive_flags & self.bit != 0
+
+    def __set__(self, instance, value: bool):
+        if not isinstance(value, bool):
+            raise TypeError(f'{self.name} needs bool, got {type(value)}')
+        if value:
+            instance.receive_flags |= self.bit
+        else:
+            instance.receive_flags &= ~self.bit
+
+
 class UserSetting:
+    __slots__ = ('user_id', 'screen_name', 'receive_flags',
+                 'custom_tag', 'custom_background', 'custom_css')
+
     user_id: int
     screen_name: str
+    receive_flags: int
 
     # user tweet receive settings
-    receive_tweet: bool = True
-    receive_retweet: bool = True
-    receive_comment: bool = True
+    receive_tweet = ReceiveFlag(1 << 0)
+    receive_retweet = ReceiveFlag(1 << 1)
+    receive_comment = ReceiveFlag(1 << 2)
 
     # user tweet component settings
-    receive_text: bool = True
-    receive_screenshot: bool = True
-    receive_translation: bool = True
-    receive_content: bool = True
+    receive_text = ReceiveFlag(1 << 3)
+    receive_screenshot = ReceiveFlag(1 << 4)
+    receive_translation = ReceiveFlag(1 << 5)
+    receive_content = ReceiveFlag(1 << 6)
 
     # user tweet receive message setting
-    receive_collapsed_message: bool = False
+    receive_collapsed_message = ReceiveFlag(1 << 7)
 
     # user custom settins
-    custom_tag: Optional[str] = None
-    custom_background: Optional[str] = None
-    custom_css: Optional[str] = None
+    custom_tag: Optional[str]
+    custom_background: Optional[str]
+    custom_css: Optional[str]
+
+    receive_keys = ('receive_tweet', 'receive_retweet', 'receive_comment', 'receive_text', 'receive_screenshot',
+                    'receive_translation', 'receive_content', 'receive_collapsed_message')
+    custom_keys = ('custom_tag', 'custom_background', 'custom_css')
+    # everything but receive_collapsed_message is on by default
+    default_receive_flags = (1 << 7) - 1
+    # the flags that change how a tweet is rendered, groups sharing them get the same message body
+    render_flags = receive_screenshot.bit | receive_text.bit | receive_translation.bit | receive_content.bit | receive_collapsed_message.bit
 
     def __init__(self, user_id: int = -1, screen_name: str = '') -> None:
         self.user_id = user_id
         self.screen_name = screen_name
+        self.receive_flags = self.default_receive_flags
+        self.custom_tag = None
+        self.custom_background = None
+        self.custom_css = None
 
     async def modify(self, key: str, value: bool):
-        if not hasattr(self, key) or not key.startswith('receive'):
+        if key not in self.receive_keys:
             return self.__err(f'不支持设置{key}')
         if not isinstance(value, bool):
             return self.__err(f'非法值类型{type(value)}，需要bool')
@@ -51,16 +108,36 @@ class UserSetting:
         setattr(self, key, value)
         return self.__ok(f'设置完成，{key}的值由{curr_value}设置为{value}')
 
+    def get_render_profile(self):
+        return self.receive_flags & self.render_flags
+
     async def to_json(self):
-        return vars(self)
+        json_content: dict[str, Any] = {
+            'user_id': self.user_id,
+            'screen_name': self.screen_name
+        }
+        for key in self.receive_keys:
+            json_content[key] = getattr(self, key)
+        for key in self.custom_keys:
+            json_content[key] = getattr(self, key)
+        return json_content
 
     @staticmethod
     async def from_json(json_content: dict[str, Any]):
-        if 'user_id' not in json_content or 'screen_name' not in json_content:
-            return None
-        user_setting = UserSetting()
+        match json_content:
+            case {'user_id': int(user_id), 'screen_name': str(screen_name)}:
+                user_setting = UserSetting(user_id, screen_name)
+            case _:
+                nonebot.logger.warning(f'invalid user setting {json_content}, skipped')
+                return None
         for key, value in json_content.items():
-            setattr(user_setting, key, value)
+            if key in UserSetting.receive_keys and isinstance(value, bool):
+                setattr(user_setting, key, value)
+            elif key in UserSetting.custom_keys and (value is None or isinstance(value, str)):
+                setattr(user_setting, key, value)
+            elif key not in ('user_id', 'screen_name'):
+                nonebot.logger.warning(
+                    f'{user_setting} => ignored invalid setting {key}={value!r}')
         return user_setting
 
     def __ok(self, message: str):
@@ -85,45 +162,77 @@ class UserSetting:
 
 
 class GroupSetting:
+    __slots__ = ('group_id', 'group_database_path', 'subscription_index', 'user_settings', 'screen_names',
+                 'history', 'history_loader', 'history_lock', 'user_settings_dirty', 'changed_user_ids')
+
     group_id: int
     group_database_path: str
 
     user_settings: dict[int, UserSetting]
-    history: list[str]
-
-    def __init__(self, group_id: int, database_path: str) -> None:
+    screen_names: dict[str, int]
+    history: Optional[History]
+    history_loader: Any
+    history_lock: asyncio.Lock
+    user_settings_dirty: bool
+    # users to upsert, or delete when no longer registered, on an incremental save
+    changed_user_ids: set[int]
+
+    def __init__(self, group_id: int, database_path: str, subscription_index=None) -> None:
         self.group_id = group_id
-        self.group_database_path = f'{database_path}\\{group_id}'
+        self.group_database_path = os.path.join(database_path, str(group_id))
+        self.subscription_index = subscription_index
         self.user_settings = dict()
-        self.history = list()
+        self.screen_names = dict()
+        self.history = None
+        self.history_loader = None
+        self.history_lock = asyncio.Lock()
+        self.user_settings_dirty = False
+        self.changed_user_ids = set()
 
     async def get_user_setting(self, user_id: int = None, screen_name: str = None):
         if user_id is None:
-            for user_setting in self.user_settings.values():
-                if user_setting.screen_name == screen_name:
-                    return user_setting
-            return None
-        else:
-            return self.user_settings.get(user_id)
+            user_id = self.screen_names.get(screen_name.lower())
+        return self.user_settings.get(user_id)
+
+    def add_user_setting(self, user_setting: UserSetting):
+        self.user_settings[user_setting.user_id] = user_setting
+        self.screen_names[user_setting.screen_name.lower()] = user_setting.user_id
 
     async def register_user_setting(self, user_id: int, screen_name: str):
         if user_id in self.user_settings:
             return self.__err(f'已存在用户{screen_name}')
-        self.user_settings[user_id] = UserSetting(user_id, screen_name)
+        self.add_user_setting(UserSetting(user_id, screen_name))
+        self.mark_dirty(user_id)
+        if self.subscription_index is not None:
+            self.subscription_index.add(user_id, self.group_id, screen_name)
         return self.__ok(f'注册用户{screen_name}成功')
 
     async def unregister_user_setting(self, user_id: int, screen_name: str):
         if user_id not in self.user_settings:
             return self.__err(f'不存在用户{screen_name}')
-        self.user_settings.pop(user_id)
+        user_setting = self.user_settings.pop(user_id)
+        self.screen_names.pop(user_setting.screen_name.lower(), None)
+        self.mark_dirty(user_id)
+        if self.subscription_index is not None:
+            self.subscription_index.discard(user_id, self.group_id)
         return self.__ok(f'删除用户{screen_name}成功')
 
+    async def rename_user_setting(self, user_id: int, screen_name: str):
+        user_setting = self.user_settings.get(user_id)
+        if user_setting is None or user_setting.screen_name == screen_name:
+            return
+        self.screen_names.pop(user_setting.screen_name.lower(), None)
+        user_setting.screen_name = screen_name
+        self.screen_names[screen_name.lower()] = user_id
+        self.mark_dirty(user_id)
+
     async def modify_user_setting(self, key: str, value: bool, user_id: int = None, screen_name: str = None):
         result_message = ''
         if user_id is None and screen_name is None:
             for user_setting in self.user_settings.values():
                 (_, message) = await user_setting.modify(key, value)
                 result_message += message + '\n'
+            self.mark_dirty()
         else:
             user_setting = await self.get_user_setting(user_id, screen_name)
             if user_setting is None:
@@ -131,48 +240,121 @@ class GroupSetting:
             else:
                 (_, message) = await user_setting.modify(key, value)
                 result_message = message
+                self.mark_dirty(user_setting.user_id)
         return self.__ok(result_message.strip())
 
-    async def add_history(self, url: str):
-        self.history.append(url)
-        if len(self.history) >= max_history_amount:
-            self.history = self.history[int(max_history_amount / 2):]
-        return len(self.history)
+    def mark_dirty(self, user_id: int = None):
+        # without a user_id every registered user counts as changed
+        self.user_settings_dirty = True
+        if user_id is None:
+            self.changed_user_ids.update(self.user_settings)
+        else:
+            self.changed_user_ids.add(user_id)
+
+    def take_user_changes(self):
+        # cleared up front so changes made during the write are not lost, restored if the write fails
+        changed_user_ids = self.changed_user_ids
+        self.user_settings_dirty = False
+        self.changed_user_ids = set()
+        return changed_user_ids
+
+    def restore_user_changes(self, changed_user_ids: set[int]):
+        self.user_settings_dirty = True
+        self.changed_user_ids.update(changed_user_ids)
+
+    def is_dirty(self):
+        return self.user_settings_dirty or (self.history is not None and len(self.history.unsaved) != 0)
+
+    async def load_history(self):
+        # history is only needed by #translate, so it is read on first use
+        if self.history is not None:
+            return
+        async with self.history_lock:
+            if self.history is None:
+                loader = self.read_history if self.history_loader is None else self.history_loader
+                history = History(max_history_amount)
+                history.restore(await loader())
+                self.history = history
+
+    async def read_history(self):
+        history_log_path = os.path.join(self.group_database_path, 'history.log')
+        if os.path.exists(history_log_path):
+            records = list()
+            async with aiofiles.open(history_log_path, 'r', encoding='utf-8') as f:
+                # one read instead of a thread hop per line
+                history_lines = (await f.read()).splitlines()
+                for line in history_lines:
+                    match line.split('\t'):
+                        case[history_id, url, user_id] if history_id.isdigit():
+                            records.append((int(history_id), url, int(user_id) if user_id.isdigit() else None))
+                        case[history_id, url] if history_id.isdigit():
+                            records.append((int(history_id), url, None))
+            return records
+        # history.txt predates stable ids, its line numbers are the ids users saw
+        history_path = os.path.join(self.group_database_path, 'history.txt')
+        if not os.path.exists(history_path):
+            return list()
+        async with aiofiles.open(history_path, 'r', encoding='utf-8') as f:
+            history_lines = await f.readlines()
+            return [(history_id, url, None) for (history_id, url) in enumerate([line.strip() for line in history_lines if line != '\n'], 1)]
+
+    async def add_history(self, url: str, user_id: int = None):
+        await self.load_history()
+        return self.history.append(url, user_id)
 
     async def get_history(self, index: int):
-        if index < 1 or index > len(self.history):
-            return self.__err(f'非法编号，编号应在1和{len(self.history)}之间')
-        return True, self.history[index - 1]
+        await self.load_history()
+        if index < 1 or index > self.history.last_id:
+            return self.__err(f'非法编号，编号应在{self.history.first_id}和{self.history.last_id}之间')
+        entry = self.history.get(index)
+        if entry is None:
+            return self.__err(f'编号{index}已过期，当前可用编号为{self.history.first_id}到{self.history.last_id}')
+        return True, entry
 
     async def load(self):
-        user_setting_path = f'{self.group_database_path}\\user.json'
+        user_setting_path = os.path.join(self.group_database_path, 'user.json')
         if os.path.exists(user_setting_path):
             async with aiofiles.open(user_setting_path, 'r', encoding='utf-8') as f:
                 json_content: dict = json.loads(await f.read())
                 for user_json_content in json_content.values():
                     user_setting = await UserSetting.from_json(user_json_content)
                     if user_setting is not None:
-                        self.user_settings[user_setting.user_id] = user_setting
-        history_path = f'{self.group_database_path}\\history.txt'
-        if os.path.exists(history_path):
-            async with aiofiles.open(history_path, 'r', encoding='utf-8') as f:
-                history_lines = await f.readlines()
-                self.history = [line.strip()
-                                for line in history_lines if line != '\n']
+                        self.add_user_setting(user_setting)
         nonebot.logger.debug(f'{self} => load completed')
 
     async def save(self):
-        user_setting_path = f'{self.group_database_path}\\user.json'
         if not os.path.exists(self.group_database_path):
             await mkdir(self.group_database_path)
-        user_setting_content = {user_id: await user_setting.to_json() for user_id, user_setting in self.user_settings.items()}
-        async with aiofiles.open(user_setting_path, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(user_setting_content, ensure_ascii=False, indent=4))
-        history_path = f'{self.group_database_path}\\history.txt'
-        async with aiofiles.open(history_path, 'w', encoding='utf-8') as f:
-            await f.writelines([f'{line}\n' for line in self.history])
+        if self.user_settings_dirty:
+            changed_user_ids = self.take_user_changes()
+            try:
+                user_setting_path = os.path.join(self.group_database_path, 'user.json')
+                user_setting_content = {user_id: await user_setting.to_json() for user_id, user_setting in self.user_settings.items()}
+                await atomic_write(user_setting_path, json.dumps(user_setting_content, ensure_ascii=False, indent=4))
+            except Exception:
+                self.restore_user_changes(changed_user_ids)
+                raise
+        if self.history is not None and len(self.history.unsaved) != 0:
+            await self.save_history()
         nonebot.logger.debug(f'{self} => save completed')
 
+    async def save_history(self):
+        history_log_path = os.path.join(self.group_database_path, 'history.log')
+        unsaved = self.history.take_unsaved()
+        try:
+            if not os.path.exists(history_log_path) or self.history.saved_amount + len(unsaved) > 2 * self.history.capacity:
+                records = self.history.get_records()
+                await atomic_write(history_log_path, ''.join([format_history_record(record) for record in records]))
+                self.history.saved_amount = len(records)
+            else:
+                async with aiofiles.open(history_log_path, 'a', encoding='utf-8') as f:
+                    await f.write(''.join([format_history_record(record) for record in unsaved]))
+                self.history.saved_amount += len(unsaved)
+        except Exception:
+            # a partly appended record is written again, the later copy wins on load
+            self.history.restore_unsaved(unsaved)
+            raise
+
     def __str__(self) -> str:
         return f'[{type(self).__name__} {self.group_id}]'
 
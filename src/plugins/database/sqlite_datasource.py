@@ -0,0 +1,196 @@
+import os
+import json
+import asyncio
+import sqlite3
+import nonebot
+
+from .models import GroupSetting, UserSetting
+from .datasource import Database
+from ..config import get_config
+
+
+schema = """
+create table if not exists meta (key text primary key, value text not null);
+create table if not exists groups (group_id integer primary key);
+create table if not exists user_settings (
+    group_id integer not null,
+    user_id integer not null,
+    screen_name text not null collate nocase,
+    settings text not null,
+    primary key (group_id, user_id)
+);
+create index if not exists user_settings_user_id on user_settings (user_id);
+create index if not exists user_settings_screen_name on user_settings (screen_name);
+create table if not exists history (
+    group_id integer not null,
+    history_id integer not null,
+    url text not null,
+    user_id integer,
+    primary key (group_id, history_id)
+);
+"""
+
+
+class SqliteDatabase(Database):
+    sqlite_path: str
+    connection: sqlite3.Connection = None
+    connection_lock: asyncio.Lock
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sqlite_path = get_config('database_sqlite_path', os.path.join(self.database_path, 'database.sqlite3'))
+        self.connection_lock = asyncio.Lock()
+
+    async def execute(self, function, *args):
+        async with self.connection_lock:
+            if self.connection is None:
+                self.connection = await asyncio.to_thread(self.connect)
+            return await asyncio.to_thread(function, self.connection, *args)
+
+    def connect(self):
+        connection = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+        connection.execute('pragma journal_mode=wal')
+        connection.execute('pragma synchronous=normal')
+        connection.executescript(schema)
+        return connection
+
+    async def load_subscriptions(self):
+        if not await self.execute(is_migrated):
+            await self.migrate()
+        return await self.execute(select_subscriptions)
+
+    async def load_group_settings(self):
+        rows = await self.execute(select_all)
+        group_settings = dict()
+        for group_id in rows['groups']:
+            group_settings[group_id] = GroupSetting(
+                group_id, self.database_path, self.subscription_index)
+        for (group_id, settings) in rows['user_settings']:
+            user_setting = await UserSetting.from_json(json.loads(settings))
+            if user_setting is not None and group_id in group_settings:
+                group_settings[group_id].add_user_setting(user_setting)
+        for group_setting in group_settings.values():
+            group_setting.history_loader = self.make_history_loader(group_setting.group_id)
+        return list(group_settings.values())
+
+    def make_history_loader(self, group_id: int):
+        async def load_history():
+            return await self.execute(select_history, group_id)
+        return load_history
+
+    async def migrate(self):
+        # one shot import of the per group user.json and history.txt files
+        group_settings = await super().load_group_settings() if os.path.isdir(self.database_path) else list()
+        for group_setting in group_settings:
+            await group_setting.load_history()
+            group_setting.history.mark_all_unsaved()
+            group_setting.mark_dirty()
+        await self.save_group_settings(group_settings)
+        await self.execute(mark_migrated)
+        nonebot.logger.debug(
+            f'{self} => migrated {len(group_settings)} groups from json files')
+
+    async def save_group_settings(self, group_settings: list[GroupSetting]):
+        changes = list()
+        taken_user_changes = list()
+        taken_history = list()
+        for group_setting in group_settings:
+            upserted_user_settings = list()
+            deleted_user_ids = list()
+            history = None
+            if group_setting.user_settings_dirty:
+                changed_user_ids = group_setting.take_user_changes()
+                taken_user_changes.append((group_setting, changed_user_ids))
+                for user_id in changed_user_ids:
+                    user_setting = group_setting.user_settings.get(user_id)
+                    if user_setting is None:
+                        deleted_user_ids.append(user_id)
+                    else:
+                        upserted_user_settings.append((user_id, user_setting.screen_name,
+                                                       json.dumps(await user_setting.to_json(), ensure_ascii=False)))
+            if group_setting.history is not None and len(group_setting.history.unsaved) != 0:
+                history = (group_setting.history.take_unsaved(),
+                           group_setting.history.first_id)
+                taken_history.append((group_setting, history[0]))
+            changes.append((group_setting.group_id, upserted_user_settings, deleted_user_ids, history))
+        try:
+            await asyncio.gather(*[self.make_group_directory(group_setting) for group_setting in group_settings])
+            await self.execute(write_changes, changes)
+        except Exception:
+            for (group_setting, changed_user_ids) in taken_user_changes:
+                group_setting.restore_user_changes(changed_user_ids)
+            for (group_setting, records) in taken_history:
+                group_setting.history.restore_unsaved(records)
+            raise
+
+    async def make_group_directory(self, group_setting: GroupSetting):
+        # custom tags, css and backgrounds are still files in the group directory
+        await asyncio.to_thread(os.makedirs, group_setting.group_database_path, exist_ok=True)
+
+    async def register_group_setting(self, group_id: int):
+        result = await super().register_group_setting(group_id)
+        if result[0]:
+            await self.make_group_directory(self.group_settings[group_id])
+        return result
+
+    async def unregister_group_setting(self, group_id: int):
+        result = await super().unregister_group_setting(group_id)
+        if result[0]:
+            await self.execute(delete_group, group_id)
+        return result
+
+    async def shutdown(self):
+        await super().shutdown()
+        if self.connection is not None:
+            async with self.connection_lock:
+                await asyncio.to_thread(self.connection.close)
+                self.connection = None
+
+
+def is_migrated(connection: sqlite3.Connection):
+    return connection.execute("select 1 from meta where key = 'migrated'").fetchone() is not None
+
+
+def mark_migrated(connection: sqlite3.Connection):
+    with connection:
+        connection.execute(
+            "insert or replace into meta (key, value) values ('migrated', '1')")
+
+
+def select_all(connection: sqlite3.Connection):
+    return {
+        'groups': [row[0] for row in connection.execute('select group_id from groups')],
+        'user_settings': connection.execute('select group_id, settings from user_settings').fetchall()
+    }
+
+
+def select_subscriptions(connection: sqlite3.Connection):
+    return connection.execute('select group_id, user_id, screen_name from user_settings join groups using (group_id)').fetchall()
+
+
+def select_history(connection: sqlite3.Connection, group_id: int):
+    return connection.execute('select history_id, url, user_id from history where group_id = ? order by history_id', (group_id,)).fetchall()
+
+
+def write_changes(connection: sqlite3.Connection, changes: list[tuple[int, list, list, tuple[list, int] | None]]):
+    with connection:
+        for (group_id, upserted_user_settings, deleted_user_ids, history) in changes:
+            connection.execute(
+                'insert or ignore into groups (group_id) values (?)', (group_id,))
+            connection.executemany('insert or replace into user_settings (group_id, user_id, screen_name, settings) values (?, ?, ?, ?)',
+                                   [(group_id, *user_setting) for user_setting in upserted_user_settings])
+            connection.executemany('delete from user_settings where group_id = ? and user_id = ?',
+                                   [(group_id, user_id) for user_id in deleted_user_ids])
+            if history is not None:
+                (records, first_id) = history
+                connection.executemany('insert or replace into history (group_id, history_id, url, user_id) values (?, ?, ?, ?)',
+                                       [(group_id, *record) for record in records])
+                connection.execute(
+                    'delete from history where group_id = ? and history_id < ?', (group_id, first_id))
+
+
+def delete_group(connection: sqlite3.Connection, group_id: int):
+    with connection:
+        for table in ('groups', 'user_settings', 'history'):
+            connection.execute(
+                f'delete from {table} where group_id = ?', (group_id,))
@@ -1,61 +1,243 @@
+import os
+import time
+import shlex
+import signal
+import asyncio
 import subprocess
 import nonebot
 
-from psutil import Popen
-from nonebot.plugin import export
+from asyncio import Event, Task
+from asyncio.subprocess import Process
+from collections import deque
+from aiohttp.client_exceptions import ClientError
+from nonebot.plugin import export, require
 
+from .network import SessionPool
+from .config import get_config
 
-async def _kill_process(process: Popen):
-    subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+
+network_dict = require('network')
+session_pool: SessionPool = network_dict.session_pool
+
+
+async def _kill_process(process: Process):
+    if process is None:
+        return
+    # npm and go-cqhttp start children of their own, the whole tree has to go
+    if os.name == 'nt':
+        # also run after the parent exited, a surviving node child would keep the port
+        killer = await asyncio.create_subprocess_exec(
+            'taskkill', '/F', '/T', '/PID', str(process.pid),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        # taskkill fails when the tree is gone already, which is fine
+        await killer.wait()
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            # the children may outlive a crashed parent, an empty group is gone already
+            pass
+    await process.wait()
+
+
+class ProcessSupervisor:
+    name: str
+    command: list[str]
+    cwd: str
+    process: Process = None
+    monitor_task: Task = None
+    ready: Event
+    probe_requested: Event
+    failures: int = 0
+    restarts: deque[float]
+    consecutive_restarts: int = 0
+
+    def __init__(self, name: str, command: list[str], cwd: str, probe=None) -> None:
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.probe = probe
+        self.probe_interval = float(
+            get_config('supervisor_probe_interval', 15))
+        self.failure_threshold = int(
+            get_config('supervisor_failure_threshold', 3))
+        self.warmup_timeout = float(
+            get_config('supervisor_warmup_timeout', 120))
+        self.backoff_base = float(
+            get_config('supervisor_backoff_base', 2))
+        self.backoff_max = float(get_config('supervisor_backoff_max', 300))
+        self.breaker_restart_amount = int(
+            get_config('supervisor_breaker_restart_amount', 5))
+        self.breaker_window = float(
+            get_config('supervisor_breaker_window', 600))
+        self.breaker_cooldown = float(
+            get_config('supervisor_breaker_cooldown', 900))
+        self.ready = Event()
+        self.probe_requested = Event()
+        self.restarts = deque()
+
+    async def startup(self):
+        if self.monitor_task is None or self.monitor_task.done():
+            self.monitor_task = asyncio.create_task(self.monitor())
+
+    async def shutdown(self):
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        self.ready.clear()
+        await _kill_process(self.process)
+        nonebot.logger.debug(f'{self} => shutdown completed')
+
+    async def wait_ready(self, timeout: float):
+        if self.ready.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def request_probe(self):
+        # a failed request only makes the next probe happen earlier, the probe decides on a restart
+        self.probe_requested.set()
+
+    async def is_healthy(self):
+        if self.process is None or self.process.returncode is not None:
+            return False
+        if self.probe is None:
+            return True
+        try:
+            return await self.probe()
+        except Exception as e:
+            nonebot.logger.debug(f'{self} => probe failed {type(e).__name__} => {e}')
+            return False
+
+    async def monitor(self):
+        while True:
+            await self.start()
+            while await self.watch():
+                pass
+            self.ready.clear()
+            nonebot.logger.warning(f'{self} => unhealthy, restarting')
+            await self.wait_restart()
+
+    async def start(self):
+        while True:
+            await _kill_process(self.process)
+            self.failures = 0
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    *self.command, cwd=self.cwd, stdin=asyncio.subprocess.DEVNULL, **self.get_spawn_options())
+            except OSError as e:
+                nonebot.logger.warning(f'{self} => start failed {e}')
+                await self.wait_restart()
+                continue
+            if await self.warm_up():
+                self.consecutive_restarts = 0
+                self.ready.set()
+                nonebot.logger.debug(f'{self} => ready')
+                return
+            nonebot.logger.warning(
+                f'{self} => not ready after {self.warmup_timeout:.0f}s')
+            await self.wait_restart()
+
+    async def warm_up(self):
+        deadline = time.time() + self.warmup_timeout
+        while time.time() < deadline:
+            if self.process.returncode is not None:
+                return False
+            if await self.is_healthy():
+                return True
+            await asyncio.sleep(1)
+        return False
+
+    async def watch(self):
+        try:
+            await asyncio.wait_for(self.probe_requested.wait(), self.probe_interval)
+        except asyncio.TimeoutError:
+            pass
+        self.probe_requested.clear()
+        if await self.is_healthy():
+            self.failures = 0
+            return True
+        if self.process.returncode is not None:
+            return False
+        self.failures += 1
+        nonebot.logger.debug(
+            f'{self} => probe failed {self.failures}/{self.failure_threshold}')
+        return self.failures < self.failure_threshold
+
+    async def wait_restart(self):
+        now = time.time()
+        while len(self.restarts) != 0 and self.restarts[0] < now - self.breaker_window:
+            self.restarts.popleft()
+        if len(self.restarts) >= self.breaker_restart_amount:
+            # too many restarts in a row, stop hammering and let whatever is wrong settle
+            nonebot.logger.warning(
+                f'{self} => circuit open, next restart in {self.breaker_cooldown:.0f}s')
+            self.restarts.clear()
+            await asyncio.sleep(self.breaker_cooldown)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** self.consecutive_restarts)
+        self.consecutive_restarts += 1
+        self.restarts.append(time.time())
+        await asyncio.sleep(delay)
+
+    def get_spawn_options(self):
+        if os.name == 'nt':
+            return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        # own process group so the whole tree can be killed at once
+        return {'start_new_session': True}
+
+    def __str__(self) -> str:
+        pid = None if self.process is None else self.process.pid
+        return f'[{type(self).__name__} {self.name} pid {pid} ready {self.ready.is_set()}]'
+
+    def __repr__(self) -> str:
+        return str(self)
 
 
 class ExternalHolder:
-    cq_http_path: str = None
-    cq_http_cmd: Popen = None
-    server_path: str = None
-    server_cmd: Popen = None
+    cq_http: ProcessSupervisor
+    server: ProcessSupervisor
 
     def __init__(self):
         config = nonebot.get_driver().config
-        self.cq_http_path = config.cq_http_path
-        self.server_path = config.server_path
-
-    async def start_cq_http(self):
-        self.cq_http_cmd = Popen(
-            'cmd.exe',
-            cwd=self.cq_http_path,
-            stdin=subprocess.PIPE,
-            creationflags=subprocess.CREATE_NEW_CONSOLE
-        )
-        self.cq_http_cmd.stdin.write(
-            bytes('go-cqhttp_windows_amd64.exe\n', 'utf-8'))
-        self.cq_http_cmd.stdin.flush()
-
-    async def start_server(self):
-        self.server_cmd = Popen(
-            'cmd.exe',
-            cwd=self.server_path,
-            stdin=subprocess.PIPE,
-            creationflags=subprocess.CREATE_NEW_CONSOLE
-        )
-        self.server_cmd.stdin.write(bytes('npm run start\n', 'utf-8'))
-        self.server_cmd.stdin.flush()
+        cq_http_command = get_config('cq_http_command', 'go-cqhttp_windows_amd64.exe' if os.name == 'nt' else './go-cqhttp')
+        server_command = get_config('server_command', 'npm.cmd run start' if os.name == 'nt' else 'npm run start')
+        self.server_url = config.server_url
+        self.server_health_path = get_config('server_health_path', '/')
+        self.cq_http = ProcessSupervisor(
+            'cq_http', self.split_command(config.cq_http_path, cq_http_command), config.cq_http_path)
+        self.server = ProcessSupervisor(
+            'server', self.split_command(config.server_path, server_command), config.server_path, self.probe_server)
 
-    async def startup(self):
-        await self.start_cq_http()
-        await self.start_server()
+    @staticmethod
+    def split_command(cwd: str, command: str | list[str]):
+        if isinstance(command, str):
+            command = shlex.split(command, posix=os.name != 'nt')
+        # create_subprocess_exec does not search cwd, so executables shipped next to the config are resolved here
+        if os.path.exists(os.path.join(cwd, command[0])):
+            command = [os.path.join(cwd, command[0]), *command[1:]]
+        return command
+
+    async def probe_server(self):
+        # any http response means the server accepts requests again
+        try:
+            async with session_pool.get('health', f'{self.server_url}{self.server_health_path}'):
+                return True
+        except (ClientError, asyncio.TimeoutError):
+            return False
 
-    async def reboot_cq_http(self):
-        await _kill_process(self.cq_http_cmd)
-        await self.start_cq_http()
+    async def startup(self):
+        await self.cq_http.startup()
+        await self.server.startup()
 
-    async def reboot_server(self):
-        await _kill_process(self.server_cmd)
-        await self.start_server()
+    async def check_cq_http(self):
+        # go-cqhttp reconnects on its own while it is alive, only a dead process needs a restart
+        self.cq_http.request_probe()
 
     async def shutdown(self):
-        await _kill_process(self.cq_http_cmd)
-        await _kill_process(self.server_cmd)
+        await self.cq_http.shutdown()
+        await self.server.shutdown()
 
 
 external_dict = export()
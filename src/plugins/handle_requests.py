@@ -35,4 +35,4 @@ async def group_unregister_handler(bot: Bot, event: GroupDecreaseNoticeEvent, st
         admin_qq: int = nonebot.get_driver().config.admin_qq
         (flag, content) = await database.unregister_group_setting(group_id=event.group_id)
         await bot.send_private_msg(user_id=admin_qq, message=f'退出群{event.group_id}，退出结果为{flag}, {content}')
-        await stream_holder.run_stream()
+        await stream_holder.resubscribe()
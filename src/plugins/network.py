@@ -0,0 +1,71 @@
+import nonebot
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from nonebot.plugin import export
+
+from .config import get_config
+
+
+default_timeouts = {
+    'screenshot': 60,
+    'translate': 10,
+    'server_translate': 60,
+    'image': 30,
+    'health': 5,
+    'default': 30
+}
+
+
+class SessionPool:
+    session: ClientSession = None
+    timeouts: dict[str, ClientTimeout]
+
+    def __init__(self) -> None:
+        self.limit = int(get_config('http_connection_limit', 100))
+        self.limit_per_host = int(
+            get_config('http_connection_limit_per_host', 16))
+        self.keepalive_timeout = float(
+            get_config('http_keepalive_timeout', 30))
+        self.dns_cache_ttl = int(get_config('http_dns_cache_ttl', 300))
+        timeouts: dict = dict(default_timeouts)
+        timeouts.update(get_config('http_timeouts', dict()))
+        self.timeouts = {endpoint: ClientTimeout(total=float(timeout))
+                         for endpoint, timeout in timeouts.items()}
+
+    async def startup(self):
+        self.get_session()
+        nonebot.logger.debug(f'{self} => startup completed')
+
+    async def shutdown(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        nonebot.logger.debug(f'{self} => shutdown completed')
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            self.session = ClientSession(
+                connector=connector, timeout=self.timeouts['default'])
+        return self.session
+
+    def get(self, endpoint: str, url: str, **kwargs):
+        return self.get_session().get(url, timeout=self.timeouts.get(endpoint, self.timeouts['default']), **kwargs)
+
+    def post(self, endpoint: str, url: str, **kwargs):
+        return self.get_session().post(url, timeout=self.timeouts.get(endpoint, self.timeouts['default']), **kwargs)
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {self.limit}/{self.limit_per_host}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+network_dict = export()
+network_dict.session_pool = SessionPool()
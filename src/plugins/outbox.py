@@ -0,0 +1,106 @@
+import os
+import json
+import asyncio
+import aiofiles
+import nonebot
+
+from typing import Any
+from aiofiles.os import remove
+
+from .config import get_config
+
+
+class Outbox:
+    journal_path: str
+    pending: dict[str, dict[str, Any]]
+    file_users: dict[str, int]
+    record_amount: int = 0
+    lock: asyncio.Lock
+
+    def __init__(self) -> None:
+        config = nonebot.get_driver().config
+        self.journal_path = os.path.join(config.database_path, 'outbox.jsonl')
+        self.max_record_amount = int(
+            get_config('outbox_max_record_amount', 10000))
+        self.pending = dict()
+        self.file_users = dict()
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        self.pending = dict()
+        if not os.path.exists(self.journal_path):
+            return list()
+        finished = set()
+        async with aiofiles.open(self.journal_path, 'r', encoding='utf-8') as f:
+            async for line in f:
+                try:
+                    record: dict = json.loads(line)
+                except ValueError:
+                    # a crash may leave the last line half written
+                    continue
+                match record:
+                    case {'op': 'put', 'id': str(job_id)} if job_id not in finished:
+                        self.pending.setdefault(job_id, record)
+                    case {'op': 'done', 'id': str(job_id)}:
+                        self.pending.pop(job_id, None)
+                        finished.add(job_id)
+        await self.compact()
+        for record in self.pending.values():
+            for path in record.get('files', list()):
+                self.retain_file(path)
+        nonebot.logger.debug(
+            f'{self} => load completed, {len(self.pending)} messages to replay')
+        return list(self.pending.values())
+
+    async def put(self, job_id: str, kind: str, target_id: int, message: str | list, files: list[str] = None):
+        record = {'op': 'put', 'id': job_id, 'kind': kind,
+                  'target_id': target_id, 'message': message}
+        if files:
+            # local files the message points at, e.g. screenshots, must outlive a restart
+            record['files'] = files
+            for path in files:
+                self.retain_file(path)
+        self.pending[job_id] = record
+        await self.append(record)
+
+    async def done(self, job_id: str):
+        record = self.pending.pop(job_id, None)
+        if record is None:
+            return
+        await self.append({'op': 'done', 'id': job_id})
+        for path in record.get('files', list()):
+            await self.release_file(path)
+        if self.record_amount > self.max_record_amount:
+            await self.compact()
+
+    def retain_file(self, path: str):
+        self.file_users[path] = self.file_users.get(path, 0) + 1
+
+    async def release_file(self, path: str):
+        users = self.file_users.get(path, 0) - 1
+        if users > 0:
+            self.file_users[path] = users
+            return
+        self.file_users.pop(path, None)
+        if os.path.exists(path):
+            await remove(path)
+
+    async def append(self, record: dict[str, Any]):
+        async with self.lock:
+            async with aiofiles.open(self.journal_path, 'a', encoding='utf-8') as f:
+                await f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.record_amount += 1
+
+    async def compact(self):
+        async with self.lock:
+            temp_path = f'{self.journal_path}.tmp'
+            async with aiofiles.open(temp_path, 'w', encoding='utf-8') as f:
+                await f.writelines([json.dumps(record, ensure_ascii=False) + '\n' for record in self.pending.values()])
+            os.replace(temp_path, self.journal_path)
+            self.record_amount = len(self.pending)
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} pending {len(self.pending)}]'
+
+    def __repr__(self) -> str:
+        return str(self)
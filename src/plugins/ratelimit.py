@@ -0,0 +1,45 @@
+import asyncio
+
+
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float
+    updated_at: float = None
+    lock: asyncio.Lock
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = asyncio.get_running_loop().time()
+        if self.updated_at is not None:
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, amount: float = 1):
+        self.refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def get_delay(self, amount: float = 1):
+        self.refill()
+        return max(0, (amount - self.tokens) / self.rate)
+
+    async def acquire(self, amount: float = 1):
+        # the lock keeps waiters in arrival order
+        async with self.lock:
+            while not self.try_acquire(amount):
+                await asyncio.sleep(self.get_delay(amount))
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {self.tokens:.2f}/{self.capacity} at {self.rate}/s]'
+
+    def __repr__(self) -> str:
+        return str(self)
@@ -1,36 +1,206 @@
+import time
+import uuid
+import random
+import asyncio
 import nonebot
 
+from asyncio import Event, Future, Task
+from collections import deque
+from nonebot.plugin import export
 from nonebot.adapters.cqhttp import Bot, MessageSegment, ActionFailed
 
+from .outbox import Outbox
+from .ratelimit import TokenBucket
+from .config import get_config
+
+
+class SendJob:
+    job_id: str
+    kind: str
+    target_id: int
+    message: str | list
+    future: Future
+    created_at: float
+
+    def __init__(self, job_id: str, kind: str, target_id: int, message: str | list) -> None:
+        self.job_id = job_id
+        self.kind = kind
+        self.target_id = target_id
+        self.message = message
+        self.future = asyncio.get_running_loop().create_future()
+        self.created_at = time.time()
+
+    def get_queue_key(self):
+        # forward messages share the queue of their group to keep the order
+        return ('private' if self.kind == 'private' else 'group', self.target_id)
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {self.kind} {self.target_id}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class SendScheduler:
+    account_buckets: dict[str, TokenBucket]
+    target_buckets: dict[tuple[str, int], TokenBucket]
+    queues: dict[tuple[str, int], deque[SendJob]]
+    workers: dict[tuple[str, int], Task]
+    outbox: Outbox
+    connected: Event
+    bot: Bot = None
+    depth: int = 0
+    average_latency: float = 0
+
+    def __init__(self) -> None:
+        self.account_rate = float(get_config('send_account_rate', 1))
+        self.account_burst = float(get_config('send_account_burst', 5))
+        self.target_rate = float(get_config('send_group_rate', 0.5))
+        self.target_burst = float(get_config('send_group_burst', 3))
+        self.max_retry_amount = int(get_config('send_max_retry_amount', 4))
+        self.backoff_base = float(get_config('send_backoff_base', 2))
+        self.backoff_max = float(get_config('send_backoff_max', 60))
+        self.non_retryable_retcodes = set(
+            get_config('send_non_retryable_retcodes', [100, 1400, 1401, 1403, 1404]))
+        self.account_buckets = dict()
+        self.target_buckets = dict()
+        self.queues = dict()
+        self.workers = dict()
+        self.outbox = Outbox()
+        self.connected = Event()
+
+    async def load(self):
+        for record in await self.outbox.load():
+            self.enqueue(SendJob(record['id'], record['kind'],
+                                 record['target_id'], record['message']))
+
+    def resume(self, bot: Bot):
+        self.bot = bot
+        self.connected.set()
+        nonebot.logger.debug(f'{self} => resumed')
+
+    async def get_bot(self):
+        # waits out a cqhttp disconnect instead of failing like nonebot.get_bot
+        await self.connected.wait()
+        return self.bot
+
+    def pause(self):
+        self.connected.clear()
+        nonebot.logger.debug(f'{self} => paused')
+
+    async def put(self, bot: Bot, kind: str, target_id: int, message: str | MessageSegment | list, files: list[str] = None):
+        if self.bot is None:
+            self.bot = bot
+        if not isinstance(message, (str, list)):
+            message = str(message)
+        job = SendJob(uuid.uuid4().hex, kind, target_id, message)
+        await self.outbox.put(job.job_id, kind, target_id, message, files)
+        self.enqueue(job)
+        return job
+
+    async def submit(self, bot: Bot, kind: str, target_id: int, message: str | MessageSegment | list):
+        job = await self.put(bot, kind, target_id, message)
+        return await asyncio.shield(job.future)
+
+    def enqueue(self, job: SendJob):
+        key = job.get_queue_key()
+        if key not in self.queues:
+            self.queues[key] = deque()
+        self.queues[key].append(job)
+        self.depth += 1
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self.work(key))
+
+    async def work(self, key: tuple[str, int]):
+        queue = self.queues[key]
+        try:
+            while len(queue) != 0:
+                job = queue.popleft()
+                try:
+                    job.future.set_result(await self.deliver(job))
+                except Exception as e:
+                    job.future.set_result(False)
+                    nonebot.logger.warning(f'{self} => {job} failed unknown error {e}')
+                finally:
+                    await self.outbox.done(job.job_id)
+                    self.depth -= 1
+                    latency = time.time() - job.created_at
+                    self.average_latency = self.average_latency * 0.9 + latency * 0.1
+                    nonebot.logger.debug(f'{self} => {job} finished after {latency:.2f}s')
+        finally:
+            self.workers.pop(key)
+            if len(queue) == 0:
+                self.queues.pop(key)
+
+    async def deliver(self, job: SendJob):
+        for attempt in range(self.max_retry_amount + 1):
+            await self.connected.wait()
+            bot = self.bot
+            await self.get_account_bucket(bot.self_id).acquire()
+            await self.get_target_bucket(job.get_queue_key()).acquire()
+            try:
+                match job.kind:
+                    case 'group':
+                        await bot.send_group_msg(group_id=job.target_id, message=job.message)
+                    case 'private':
+                        await bot.send_private_msg(user_id=job.target_id, message=job.message)
+                    case 'forward':
+                        await bot.call_api('send_group_forward_msg', group_id=job.target_id, messages=job.message)
+                return True
+            except ActionFailed as e:
+                retcode = e.info.get('retcode', 'no-code')
+                nonebot.logger.warning(
+                    f'send to {job.kind} {job.target_id} failed with retcode {retcode}')
+                if retcode in self.non_retryable_retcodes:
+                    return False
+            except Exception as e:
+                nonebot.logger.warning(
+                    f'send to {job.kind} {job.target_id} failed unknown error {e}')
+            if attempt < self.max_retry_amount:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        return False
+
+    def get_account_bucket(self, self_id: str):
+        if self_id not in self.account_buckets:
+            self.account_buckets[self_id] = TokenBucket(
+                self.account_rate, self.account_burst)
+        return self.account_buckets[self_id]
+
+    def get_target_bucket(self, key: tuple[str, int]):
+        if key not in self.target_buckets:
+            self.target_buckets[key] = TokenBucket(
+                self.target_rate, self.target_burst)
+        return self.target_buckets[key]
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} depth {self.depth} latency {self.average_latency:.2f}s]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+send_scheduler = SendScheduler()
+send_dict = export()
+send_dict.send_scheduler = send_scheduler
+
 
 async def send_group_message(bot: Bot, group_id: int, message: str | MessageSegment):
-    try:
-        await bot.send_group_msg(group_id=group_id, message=message)
-    except ActionFailed as e:
-        nonebot.logger.warning(
-            f'send to group {group_id} failed with retcode {e.info.get("retcode", "no-code")}')
-    except Exception as e:
-        nonebot.logger.warning(
-            f'send to group {group_id} failed unknown error {e}')
+    return await send_scheduler.submit(bot, 'group', group_id, message)
 
 
 async def send_private_message(bot: Bot, user_id: int, message: str | MessageSegment):
-    try:
-        await bot.send_private_msg(user_id=user_id, message=message)
-    except ActionFailed as e:
-        nonebot.logger.warning(
-            f'send to user {user_id} failed with retcode {e.info.get("retcode", "no-code")}')
-    except Exception as e:
-        nonebot.logger.warning(
-            f'send to user {user_id} failed unknown error {e}')
+    return await send_scheduler.submit(bot, 'private', user_id, message)
 
 
 async def send_forward_message(bot: Bot, group_id: int, messages: list):
-    try:
-        await bot.call_api('send_group_forward_msg', group_id=group_id, messages=messages)
-    except ActionFailed as e:
-        nonebot.logger.warning(
-            f'send to group {group_id} failed with retcode {e.info.get("retcode", "no-code")}')
-    except Exception as e:
-        nonebot.logger.warning(
-            f'send to group {group_id} failed unknown error {e}')
+    return await send_scheduler.submit(bot, 'forward', group_id, messages)
+
+
+async def queue_group_message(bot: Bot, group_id: int, message: str | MessageSegment, files: list[str] = None):
+    # returns once the message is in the outbox, the scheduler delivers it in order from there
+    return await send_scheduler.put(bot, 'group', group_id, message, files)
+
+
+async def queue_forward_message(bot: Bot, group_id: int, messages: list, files: list[str] = None):
+    return await send_scheduler.put(bot, 'forward', group_id, messages, files)
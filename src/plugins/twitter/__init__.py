@@ -1,6 +1,8 @@
 from nonebot.plugin import require, export
 
 from .holder import StreamHolder
+from .render import RenderQueue, render_queue
+from .translation import Translator, translator
 
 from ..database import Database
 from ..external import ExternalHolder
@@ -15,3 +17,5 @@ stream_holder = StreamHolder(database, external_holder)
 
 twitter_dict = export()
 twitter_dict.stream_holder = stream_holder
+twitter_dict.translator = translator
+twitter_dict.render_queue = render_queue
@@ -0,0 +1,120 @@
+import time
+
+from typing import Hashable
+from collections import deque, OrderedDict
+
+from .models import Tweet
+
+
+class RecentIds:
+    capacity: int
+    ttl: float
+    order: deque[tuple[Hashable, float]]
+    seen: set[Hashable]
+
+    def __init__(self, capacity: int, ttl: float = None) -> None:
+        self.capacity = capacity
+        self.ttl = ttl
+        self.order = deque()
+        self.seen = set()
+
+    def expire(self):
+        if self.ttl is None:
+            return
+        deadline = time.time() - self.ttl
+        while len(self.order) != 0 and self.order[0][1] < deadline:
+            self.seen.discard(self.order.popleft()[0])
+
+    def add(self, item_id: Hashable):
+        self.expire()
+        if item_id in self.seen:
+            return False
+        if len(self.order) >= self.capacity:
+            self.seen.discard(self.order.popleft()[0])
+        self.order.append((item_id, time.time()))
+        self.seen.add(item_id)
+        return True
+
+    def discard(self, item_id: Hashable):
+        # rare, only used to take back a delivery that failed
+        if item_id not in self.seen:
+            return
+        self.seen.discard(item_id)
+        for entry in self.order:
+            if entry[0] == item_id:
+                self.order.remove(entry)
+                break
+
+    def __contains__(self, item_id: Hashable) -> bool:
+        self.expire()
+        return item_id in self.seen
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+
+class RenderEntry:
+    tweet: Tweet
+    users: int = 0
+    last_used: float
+
+    def __init__(self, tweet: Tweet) -> None:
+        self.tweet = tweet
+        self.last_used = time.time()
+
+
+class RenderCache:
+    capacity: int
+    ttl: float
+    entries: OrderedDict[int, RenderEntry]
+    hit: int = 0
+    miss: int = 0
+
+    def __init__(self, capacity: int, ttl: float) -> None:
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    async def attach(self, tweet: Tweet):
+        entry = self.entries.get(tweet.original_id)
+        if entry is None:
+            entry = self.entries[tweet.original_id] = RenderEntry(tweet)
+            self.miss += 1
+        else:
+            # the retweet shares the screenshot and translation futures of the first rendering
+            tweet.components = entry.tweet.components
+            self.hit += 1
+        entry.users += 1
+        entry.last_used = time.time()
+        self.entries.move_to_end(tweet.original_id)
+        await self.evict()
+
+    async def release(self, tweet: Tweet):
+        entry = self.entries.get(tweet.original_id)
+        if entry is None or tweet.components is not entry.tweet.components:
+            await tweet.clean_up()
+            return
+        entry.users -= 1
+        entry.last_used = time.time()
+        await self.evict()
+
+    async def evict(self):
+        deadline = time.time() - self.ttl
+        for (original_id, entry) in list(self.entries.items()):
+            if entry.users > 0:
+                continue
+            if entry.last_used >= deadline and len(self.entries) <= self.capacity:
+                continue
+            self.entries.pop(original_id)
+            await entry.tweet.clean_up()
+
+    async def clear(self):
+        for entry in self.entries.values():
+            await entry.tweet.clean_up()
+        self.entries.clear()
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {len(self.entries)} hit {self.hit} miss {self.miss}]'
+
+    def __repr__(self) -> str:
+        return str(self)
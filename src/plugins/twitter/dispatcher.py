@@ -0,0 +1,101 @@
+import asyncio
+import nonebot
+
+from asyncio import Future, Semaphore
+from nonebot.adapters.cqhttp import Bot
+
+from ..database import GroupSetting
+from .models import Tweet
+from .journal import IngestionJournal
+from ..config import get_config
+
+
+class Dispatcher:
+    max_concurrency: int
+    max_group_concurrency: int
+    max_pending_tweets: int
+    pending_tweets: int = 0
+
+    global_semaphore: Semaphore
+    pending_semaphore: Semaphore
+    group_semaphores: dict[int, Semaphore]
+    group_tails: dict[int, Future]
+    journal: IngestionJournal
+
+    def __init__(self, journal: IngestionJournal) -> None:
+        self.journal = journal
+        self.max_concurrency = int(
+            get_config('dispatch_max_concurrency', 16))
+        self.max_group_concurrency = int(
+            get_config('dispatch_max_group_concurrency', 2))
+        self.max_pending_tweets = int(
+            get_config('dispatch_max_pending_tweets', 32))
+        self.global_semaphore = Semaphore(self.max_concurrency)
+        self.pending_semaphore = Semaphore(self.max_pending_tweets)
+        self.group_semaphores = dict()
+        self.group_tails = dict()
+
+    async def acquire(self):
+        await self.pending_semaphore.acquire()
+        self.pending_tweets += 1
+
+    def release(self):
+        self.pending_tweets -= 1
+        self.pending_semaphore.release()
+
+    def reserve(self, group_settings: list[GroupSetting]):
+        # must be called in stream order, the reserved futures chain the sends of every group
+        loop = asyncio.get_running_loop()
+        reservations = list()
+        for group_setting in group_settings:
+            done = loop.create_future()
+            previous = self.group_tails.get(group_setting.group_id)
+            self.group_tails[group_setting.group_id] = done
+            reservations.append((group_setting, previous, done))
+        return reservations
+
+    async def fan_out(self, bot: Bot, tweet: Tweet, reservations: list[tuple[GroupSetting, Future | None, Future]]):
+        results = await asyncio.gather(*[
+            self.deliver(bot, tweet, group_setting, previous, done) for (group_setting, previous, done) in reservations
+        ], return_exceptions=True)
+        failed_group_settings = list()
+        for (group_setting, _, _), result in zip(reservations, results):
+            if isinstance(result, Exception):
+                failed_group_settings.append(group_setting)
+                nonebot.logger.warning(
+                    f'{self} => deliver {tweet.tweet_url} to group {group_setting.group_id} failed {type(result).__name__} => {result}')
+        return failed_group_settings
+
+    async def deliver(self, bot: Bot, tweet: Tweet, group_setting: GroupSetting, previous: Future | None, done: Future):
+        try:
+            async with self.get_group_semaphore(group_setting.group_id):
+                async with self.global_semaphore:
+                    messages = await tweet.make_message(bot, group_setting)
+            if previous is not None:
+                await asyncio.shield(previous)
+            # numbered after the previous tweet of the group, so numbers follow the delivery order
+            messages = await tweet.number_message(bot, group_setting, messages)
+            # shielded so a shutdown cannot split the outbox write from its journal record
+            await asyncio.shield(self.queue(bot, tweet, group_setting, messages))
+        finally:
+            done.set_result(None)
+            if self.group_tails.get(group_setting.group_id) is done:
+                self.group_tails.pop(group_setting.group_id)
+
+    async def queue(self, bot: Bot, tweet: Tweet, group_setting: GroupSetting, messages: list[tuple[bool, str | list]]):
+        if len(messages) != 0:
+            async with self.global_semaphore:
+                await tweet.send_prepared_message(bot, group_setting, messages)
+        await self.journal.queued(tweet, group_setting.group_id)
+
+    def get_group_semaphore(self, group_id: int):
+        if group_id not in self.group_semaphores:
+            self.group_semaphores[group_id] = Semaphore(
+                self.max_group_concurrency)
+        return self.group_semaphores[group_id]
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} pending {self.pending_tweets}/{self.max_pending_tweets}]'
+
+    def __repr__(self) -> str:
+        return str(self)
@@ -8,11 +8,19 @@ from typing import Literal
 from nonebot.adapters.cqhttp import Bot
 from tweepy import Response, Client, User
 
-from ..send import send_private_message
+from ..send import send_private_message, send_scheduler
 from ..database import Database
 from ..external import ExternalHolder
-from .models import Tweet
+from .models import Tweet, TweetPlan
 from .stream import Stream
+from .dispatcher import Dispatcher
+from .dedup import RecentIds, RenderCache
+from .user_cache import TwitterUser, UserCache
+from .journal import IngestionJournal
+from ..config import get_config
+
+
+max_lookup_amount = 100
 
 
 class StreamHolder:
@@ -22,7 +30,20 @@ class StreamHolder:
                         tuple[Literal[False], str]] = None
     database: Database = None
     external_holder: ExternalHolder = None
+    dispatcher: Dispatcher = None
     consume_task: Task = None
+    solve_tasks: set[Task] = None
+    resubscribe_task: Task = None
+    resubscribe_deadline: float = 0
+    resubscribe_first_at: float = None
+    stream_lock: asyncio.Lock = None
+    recent_tweet_ids: RecentIds = None
+    delivered_tweet_ids: RecentIds = None
+    render_cache: RenderCache = None
+    user_cache: UserCache = None
+    journal: IngestionJournal = None
+    compact_task: Task = None
+    replay_tweets: list[tuple[Tweet, list[int]]] = None
 
     def __init__(self, database: Database, external_holder: ExternalHolder) -> None:
         self.database = database
@@ -35,58 +56,212 @@ class StreamHolder:
         self.twitter_access_token_secret = getattr(
             config, 'twitter_access_token_secret')
         self.twitter_bearer_token = getattr(config, 'twitter_bearer_token')
-        self.stream_queue = Queue()
+        self.stream_queue = Queue(
+            maxsize=int(get_config('stream_queue_size', 64)))
+        self.resubscribe_debounce = float(
+            get_config('stream_resubscribe_debounce', 10))
+        self.resubscribe_max_wait = float(
+            get_config('stream_resubscribe_max_wait', 60))
+        self.connect_timeout = float(
+            get_config('stream_connect_timeout', 30))
+        self.shutdown_timeout = float(
+            get_config('stream_shutdown_timeout', 10))
+        self.solve_tasks = set()
+        self.stream_lock = asyncio.Lock()
+        self.user_cache = UserCache()
+        self.journal = IngestionJournal()
+        self.dispatcher = Dispatcher(self.journal)
+        dedup_ttl = float(get_config('stream_dedup_ttl', 3600))
+        self.recent_tweet_ids = RecentIds(
+            int(get_config('stream_recent_tweet_amount', 4096)), dedup_ttl)
+        self.delivered_tweet_ids = RecentIds(
+            int(get_config('stream_delivered_tweet_amount', 65536)), dedup_ttl)
+        self.render_cache = RenderCache(
+            int(get_config('render_cache_amount', 256)),
+            float(get_config('render_cache_ttl', 600)))
 
     async def run_stream(self):
-        if self.stream is not None:
-            self.stream.disconnect()
-        stream = Stream(self.twitter_consumer_key, self.twitter_consumer_secret,
-                        self.twitter_access_token, self.twitter_access_token_secret)
-        stream.stream_queue = self.stream_queue
-        stream.registered_users = [user_setting.user_id for user_setting in await self.database.get_all_user_settings()]
-        self.stream = stream
-        self.stream.filter(follow=self.stream.registered_users)
-        nonebot.logger.debug(
-            f'running stream with registered users {self.stream.registered_users}')
+        async with self.stream_lock:
+            registered_users = await self.database.get_registered_users()
+            old_stream = self.stream
+            if old_stream is not None and old_stream.is_running():
+                added = registered_users - old_stream.registered_users
+                removed = old_stream.registered_users - registered_users
+                if len(added) == 0 and len(removed) == 0:
+                    nonebot.logger.debug(
+                        'registered users not changed, keep current stream')
+                    return
+                nonebot.logger.debug(
+                    f'resubscribing stream, added {added}, removed {removed}')
+            stream = Stream(self.twitter_consumer_key, self.twitter_consumer_secret,
+                            self.twitter_access_token, self.twitter_access_token_secret)
+            stream.stream_queue = self.stream_queue
+            stream.recent_tweet_ids = self.recent_tweet_ids
+            stream.journal = self.journal
+            stream.set_registered_users(registered_users)
+            stream.filter(follow=list(stream.registered_users))
+            self.stream = stream
+            if old_stream is not None:
+                try:
+                    await asyncio.wait_for(stream.connected.wait(), self.connect_timeout)
+                except asyncio.TimeoutError:
+                    nonebot.logger.warning(
+                        f'new stream not connected in {self.connect_timeout}s, disconnecting old stream anyway')
+                old_stream.disconnect()
+            nonebot.logger.debug(
+                f'running stream with registered users {stream.registered_users}')
+
+    async def resubscribe(self):
+        now = asyncio.get_running_loop().time()
+        if self.resubscribe_first_at is None:
+            self.resubscribe_first_at = now
+        # a steady trickle of changes would postpone the run forever without the cap
+        self.resubscribe_deadline = min(now + self.resubscribe_debounce,
+                                        self.resubscribe_first_at + self.resubscribe_max_wait)
+        if self.resubscribe_task is None or self.resubscribe_task.done():
+            self.resubscribe_task = asyncio.create_task(
+                self.delayed_run_stream())
+
+    async def delayed_run_stream(self):
+        loop = asyncio.get_running_loop()
+        # changes made while the stream is being replaced start another wait
+        while self.resubscribe_first_at is not None:
+            while (delay := self.resubscribe_deadline - loop.time()) > 0:
+                await asyncio.sleep(delay)
+            self.resubscribe_first_at = None
+            await self.run_stream()
 
     async def consume_stream(self):
+        # the stream may connect before the group settings it is delivered to are loaded
+        await self.database.wait_loaded()
         while True:
             content = await self.stream_queue.get()
-            consume_task = asyncio.create_task(self.solve_stream_content(content))
+            await self.dispatcher.acquire()
+            try:
+                match content:
+                    case(True, tweet):
+                        consume_task = await self.plan_tweet(tweet)
+                    case _:
+                        consume_task = asyncio.create_task(
+                            self.solve_stream_content(content))
+            except Exception as e:
+                # one bad item must not stop the loop for good
+                consume_task = None
+                nonebot.logger.warning(
+                    f'{type(self).__name__} consume content exception {type(e).__name__} => {e}')
+            if consume_task is None:
+                self.dispatcher.release()
+                continue
+            self.solve_tasks.add(consume_task)
             consume_task.add_done_callback(self.solve_stream_content_callback)
-    
+
+    async def plan_tweet(self, tweet: Tweet):
+        # runs inline, the reservations have to be made in stream order
+        await self.database.rename_user(tweet.user_id, tweet.user_screen_name)
+        group_settings = [group_setting for group_setting in await self.database.get_group_registered_for_user(tweet.user_id)
+                          if (group_setting.group_id, tweet.original_id) not in self.delivered_tweet_ids]
+        plan = await tweet.make_plan(group_settings)
+        if plan.is_empty():
+            nonebot.logger.debug(
+                f'no group accepts {tweet.tweet_url}, dropped')
+            await self.journal.done(tweet)
+            return None
+        for group_setting in plan.group_settings:
+            self.delivered_tweet_ids.add(
+                (group_setting.group_id, tweet.original_id))
+        reservations = self.dispatcher.reserve(plan.group_settings)
+        return asyncio.create_task(self.solve_tweet(tweet, plan, reservations))
+
+    async def solve_tweet(self, tweet: Tweet, plan: TweetPlan, reservations: list):
+        failed_group_settings = plan.group_settings
+        try:
+            await self.render_cache.attach(tweet)
+            await tweet.prefetch(plan)
+            bot: Bot = await send_scheduler.get_bot()
+            failed_group_settings = await self.dispatcher.fan_out(bot, tweet, reservations)
+        finally:
+            for (_, _, done) in reservations:
+                if not done.done():
+                    done.set_result(None)
+            await self.render_cache.release(tweet)
+            if len(failed_group_settings) == 0:
+                await self.journal.done(tweet)
+            else:
+                # the journal entry stays pending, a replay only goes to the groups that never reached the outbox
+                for group_setting in failed_group_settings:
+                    self.delivered_tweet_ids.discard(
+                        (group_setting.group_id, tweet.original_id))
+
     async def solve_stream_content(self, content: tuple[Literal[True], Tweet] | tuple[Literal[False], str]):
-        bot: Bot = nonebot.get_bot()
+        bot: Bot = await send_scheduler.get_bot()
         match content:
-            case(True, tweet):
-                group_settings = await self.database.get_group_registered_for_user(tweet.user_id)
-                for group_setting in group_settings:
-                    await tweet.send_message(bot, group_setting)
-                await tweet.clean_up()
             case(False, err_message):
                 admin_qq: int = nonebot.get_driver().config.admin_qq
                 await send_private_message(bot, admin_qq, err_message)
             case _:
                 admin_qq: int = nonebot.get_driver().config.admin_qq
                 await send_private_message(bot, admin_qq, f'unknown object {content}')
-    
+
     def solve_stream_content_callback(self, task: Task):
+        self.solve_tasks.discard(task)
+        self.dispatcher.release()
+        if task.cancelled():
+            return
         exception = task.exception()
         if exception is not None:
             nonebot.logger.warning(f'{type(self).__name__} solve content exception {type(exception).__name__} => {exception}')
 
+    async def load(self):
+        await self.user_cache.load()
+        self.replay_tweets = await self.journal.load()
 
     async def startup(self):
+        await self.database.wait_ready()
         await self.run_stream()
-        self.consume_task = asyncio.create_task(self.consume_stream())
+        if self.consume_task is None or self.consume_task.done():
+            self.consume_task = asyncio.create_task(self.consume_stream())
+        if self.compact_task is None or self.compact_task.done():
+            self.compact_task = asyncio.create_task(
+                self.journal.run_compaction())
+
+    async def replay(self):
+        if self.replay_tweets is not None:
+            replay_tweets = self.replay_tweets
+            self.replay_tweets = None
+            for (tweet, group_ids) in replay_tweets:
+                self.recent_tweet_ids.add(tweet.tweet_id)
+                # these groups got the message into the outbox before the restart, it replays them
+                for group_id in group_ids:
+                    self.delivered_tweet_ids.add((group_id, tweet.original_id))
+                await self.stream_queue.put((True, tweet))
 
     async def shutdown(self):
+        if self.resubscribe_task is not None:
+            self.resubscribe_task.cancel()
         if self.stream is not None:
             self.stream.disconnect()
         if self.consume_task is not None:
             self.consume_task.cancel()
+        if self.compact_task is not None:
+            self.compact_task.cancel()
+        # deliveries left running would take history ids after the final database save
+        if len(self.solve_tasks) != 0:
+            (_, pending) = await asyncio.wait(set(self.solve_tasks), timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.render_cache.clear()
 
-    async def client_get_user(self, screen_name: str):
+    async def client_get_users(self, screen_names: list[str]) -> dict[str, TwitterUser | None]:
+        users = dict()
+        missing_screen_names = list()
+        for screen_name in screen_names:
+            cached_user = await self.user_cache.get(screen_name)
+            users[screen_name.lower()] = cached_user
+            if cached_user is None and screen_name.lower() not in missing_screen_names:
+                missing_screen_names.append(screen_name.lower())
+        if len(missing_screen_names) == 0:
+            return users
         if self.client is None:
             self.client = Client(
                 bearer_token=self.twitter_bearer_token,
@@ -95,10 +270,18 @@ class StreamHolder:
                 access_token=self.twitter_access_token,
                 access_token_secret=self.twitter_access_token_secret
             )
-        try:
-            response: Response = self.client.get_user(username=screen_name)
-            if isinstance(response.data, User):
-                return True, response.data
-            return False, None
-        except Exception:
-            return False, None
+        for i in range(0, len(missing_screen_names), max_lookup_amount):
+            chunk = missing_screen_names[i:i + max_lookup_amount]
+            try:
+                response: Response = await asyncio.to_thread(self.client.get_users, usernames=chunk)
+            except Exception as e:
+                nonebot.logger.warning(
+                    f'{type(self).__name__} get users failed {type(e).__name__} => {e}')
+                continue
+            for data in response.data or list():
+                if isinstance(data, User):
+                    user = TwitterUser(data.id, data.username, data.name)
+                    await self.user_cache.put(user)
+                    users[user.screen_name.lower()] = user
+        await self.user_cache.save()
+        return users
@@ -0,0 +1,97 @@
+import os
+import json
+import asyncio
+import aiofiles
+import nonebot
+
+from typing import Any
+
+from .models import Tweet
+from ..config import get_config
+
+
+class IngestionJournal:
+    journal_path: str
+    pending: dict[int, dict[str, Any]]
+    record_amount: int = 0
+    lock: asyncio.Lock
+
+    def __init__(self) -> None:
+        config = nonebot.get_driver().config
+        self.journal_path = os.path.join(config.database_path, 'ingestion.jsonl')
+        self.compact_interval = float(
+            get_config('ingestion_compact_interval', 600))
+        self.pending = dict()
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        self.pending = dict()
+        if not os.path.exists(self.journal_path):
+            return list()
+        async with aiofiles.open(self.journal_path, 'r', encoding='utf-8') as f:
+            async for line in f:
+                try:
+                    record: dict = json.loads(line)
+                except ValueError:
+                    continue
+                match record:
+                    case {'op': 'put', 'id': int(tweet_id), 'tweet': dict()}:
+                        self.pending[tweet_id] = record
+                    case {'op': 'queued', 'id': int(tweet_id), 'group_id': int(group_id)} if tweet_id in self.pending:
+                        self.pending[tweet_id].setdefault('group_ids', list()).append(group_id)
+                    case {'op': 'done', 'id': int(tweet_id)}:
+                        self.pending.pop(tweet_id, None)
+        await self.compact()
+        tweets = list()
+        for record in self.pending.values():
+            tweet = await Tweet.from_json(record['tweet'])
+            if tweet is not None:
+                tweets.append((tweet, record.get('group_ids', list())))
+        nonebot.logger.debug(
+            f'{self} => load completed, {len(tweets)} tweets to replay')
+        return tweets
+
+    async def put(self, tweet: Tweet):
+        record = {'op': 'put', 'id': tweet.tweet_id, 'tweet': await tweet.to_json()}
+        self.pending[tweet.tweet_id] = record
+        await self.append(record)
+
+    async def queued(self, tweet: Tweet, group_id: int):
+        # the outbox replays the group's message itself, a replayed tweet must skip the group
+        record = self.pending.get(tweet.tweet_id)
+        if record is None:
+            return
+        record.setdefault('group_ids', list()).append(group_id)
+        await self.append({'op': 'queued', 'id': tweet.tweet_id, 'group_id': group_id})
+
+    async def done(self, tweet: Tweet):
+        if self.pending.pop(tweet.tweet_id, None) is None:
+            return
+        await self.append({'op': 'done', 'id': tweet.tweet_id})
+
+    async def append(self, record: dict[str, Any]):
+        async with self.lock:
+            async with aiofiles.open(self.journal_path, 'a', encoding='utf-8') as f:
+                await f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.record_amount += 1
+
+    async def compact(self):
+        async with self.lock:
+            temp_path = f'{self.journal_path}.tmp'
+            async with aiofiles.open(temp_path, 'w', encoding='utf-8') as f:
+                await f.writelines([json.dumps(record, ensure_ascii=False) + '\n' for record in self.pending.values()])
+            os.replace(temp_path, self.journal_path)
+            self.record_amount = len(self.pending)
+        nonebot.logger.debug(f'{self} => compact completed')
+
+    async def run_compaction(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            if self.record_amount > len(self.pending):
+                await self.compact()
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} pending {len(self.pending)}]'
+
+    def __repr__(self) -> str:
+        return str(self)
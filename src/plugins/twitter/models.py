@@ -1,137 +1,263 @@
-import os
+import asyncio
 import nonebot
 
-from aiofiles.os import remove
+from typing import Any
 from nonebot.adapters.cqhttp import Bot, MessageSegment
 from tweepy import user
 
-from .utils import get_screenshot_and_text, get_translation, make_forward_message_node
+from .utils import get_status_text, make_forward_message_node
+from .render import render_queue
+from .translation import translator
 from ..database import GroupSetting, UserSetting
-from ..send import send_forward_message, send_group_message
+from ..send import queue_forward_message, queue_group_message, send_scheduler
+
+
+class TweetPlan:
+    group_settings: list[GroupSetting]
+    need_screenshot: bool = False
+    need_text: bool = False
+    need_translation: bool = False
+    need_content: bool = False
+
+    def __init__(self) -> None:
+        self.group_settings = list()
+
+    def add(self, group_setting: GroupSetting, user_setting: UserSetting):
+        self.group_settings.append(group_setting)
+        self.need_screenshot = self.need_screenshot or user_setting.receive_screenshot
+        self.need_text = self.need_text or user_setting.receive_text
+        self.need_translation = self.need_translation or user_setting.receive_translation
+        self.need_content = self.need_content or user_setting.receive_content
+
+    def is_empty(self):
+        return len(self.group_settings) == 0
+
+    def __str__(self) -> str:
+        components = [name for name in ('screenshot', 'text', 'translation', 'content')
+                      if getattr(self, f'need_{name}')]
+        return f'[{type(self).__name__} {len(self.group_settings)} groups {components}]'
+
+    def __repr__(self) -> str:
+        return str(self)
 
 
 class Tweet:
+    __slots__ = ('tweet_id', 'original_id', 'tweet_url', 'tweet_type', 'user_id',
+                 'user_screen_name', 'text', 'media_urls', 'components')
+
     tweet_id: int
+    original_id: int
     tweet_url: str
     tweet_type: str
     user_id: int
     user_screen_name: str
-    entities: dict
-    loaded_content: dict
-
-    def __init__(self, status) -> None:
-        self.status = status
-        self.tweet_id = getattr(status, 'id')
-        self.user = getattr(status, 'author')
-        self.user_id = getattr(self.user, 'id')
-        self.user_screen_name = getattr(self.user, 'screen_name')
+    text: str
+    media_urls: list[str]
+    components: dict[str, asyncio.Future]
+
+    def __init__(self, tweet_id: int, user_id: int, user_screen_name: str, tweet_type: str, text: str, media_urls: list[str], original_id: int = None) -> None:
+        self.tweet_id = tweet_id
+        self.original_id = tweet_id if original_id is None else original_id
+        self.user_id = user_id
+        self.user_screen_name = user_screen_name
         self.tweet_url = f'https://twitter.com/{self.user_screen_name}/status/{self.tweet_id}'
-        self.tweet_type = 'tweet'
+        self.tweet_type = tweet_type
+        self.text = text
+        self.media_urls = media_urls
+        self.components = dict()
+
+    @staticmethod
+    def from_status(status):
+        user = getattr(status, 'author')
+        tweet_type = 'tweet'
+        original_id = getattr(status, 'id')
         if hasattr(status, 'retweeted_status'):
-            self.tweet_type = 'retweet'
+            tweet_type = 'retweet'
+            original_id = getattr(status.retweeted_status, 'id')
         elif getattr(status, 'in_reply_to_status_id') is not None:
-            self.tweet_type = 'comment'
-        self.entities = getattr(status, 'extended_entities', dict())
-        self.loaded_content = dict()
-
-    async def load_screenshot_and_text(self):
-        if 'text' not in self.loaded_content:
-            await get_screenshot_and_text(self.tweet_url, self.loaded_content)
-
-    async def load_translation(self):
-        if 'translation' not in self.loaded_content:
-            await get_translation(self.loaded_content['text'], self.loaded_content)
-
-    async def load_content(self):
-        if 'content' not in self.loaded_content:
-            medias: list[dict] = self.entities.get('media', list())
-            media_urls = list()
-            for i in range(min(4, len(medias))):
-                media_urls.append(medias[i].get('media_url_https'))
-            if len(media_urls) != 0:
-                self.loaded_content['content'] = media_urls
-            else:
-                self.loaded_content['content'] = list()
+            tweet_type = 'comment'
+        entities: dict = getattr(status, 'extended_entities', dict())
+        media_urls = [media.get('media_url_https')
+                      for media in entities.get('media', list())[:4]]
+        return Tweet(getattr(status, 'id'), getattr(user, 'id'), getattr(user, 'screen_name'),
+                     tweet_type, get_status_text(status), media_urls, original_id)
+
+    async def to_json(self):
+        return {
+            'tweet_id': self.tweet_id,
+            'user_id': self.user_id,
+            'user_screen_name': self.user_screen_name,
+            'tweet_type': self.tweet_type,
+            'text': self.text,
+            'media_urls': self.media_urls,
+            'original_id': self.original_id
+        }
+
+    @staticmethod
+    async def from_json(json_content: dict[str, Any]):
+        match json_content:
+            case {'tweet_id': int(tweet_id), 'user_id': int(user_id), 'user_screen_name': str(user_screen_name),
+                  'tweet_type': str(tweet_type), 'text': str(text), 'media_urls': list(media_urls)}:
+                return Tweet(tweet_id, user_id, user_screen_name, tweet_type, text, media_urls, json_content.get('original_id'))
+            case _:
+                return None
+
+    def load(self, name: str, loader):
+        if name not in self.components:
+            self.components[name] = asyncio.ensure_future(loader())
+        # shielded so a cancelled group sender does not cancel the fetch shared with other groups
+        return asyncio.shield(self.components[name])
 
-    async def make_normal_message(self, group_setting: GroupSetting, user_setting: UserSetting):
+    async def load_screenshot_and_text(self, priority: int = 0) -> dict[str, str]:
+        return await self.load('screenshot', lambda: self.render_screenshot(priority))
+
+    async def render_screenshot(self, priority: int):
+        screenshot = await render_queue.submit(self.tweet_url, priority)
+        if 'screenshot_path' in screenshot:
+            # the tweet holds the file until it is cleaned up, queued messages hold it on their own
+            send_scheduler.outbox.retain_file(screenshot['screenshot_path'])
+        return screenshot
+
+    def get_screenshot_path(self):
+        screenshot = self.components.get('screenshot')
+        if screenshot is None or not screenshot.done() or screenshot.cancelled() or screenshot.exception() is not None:
+            return None
+        return screenshot.result().get('screenshot_path')
+
+    async def load_translation(self) -> str:
+        return await self.load('translation', lambda: translator.translate(self.text))
+
+    async def load_content(self) -> list[str]:
+        return self.media_urls
+
+    async def make_plan(self, group_settings: list[GroupSetting]):
+        plan = TweetPlan()
+        for group_setting in group_settings:
+            user_setting = await group_setting.get_user_setting(user_id=self.user_id)
+            if user_setting is None or not getattr(user_setting, f'receive_{self.tweet_type}'):
+                continue
+            plan.add(group_setting, user_setting)
+        nonebot.logger.debug(f'{self.tweet_url} planned {plan}')
+        return plan
+
+    async def prefetch(self, plan: TweetPlan):
+        loaders = list()
+        if plan.need_screenshot:
+            # tweets reaching more groups are rendered first
+            loaders.append(self.load_screenshot_and_text(len(plan.group_settings)))
+        if plan.need_translation:
+            loaders.append(self.load_translation())
+        if plan.need_content:
+            loaders.append(self.load_content())
+        await asyncio.gather(*loaders)
+
+    async def make_normal_body(self, user_setting: UserSetting):
         message = ''
-        if user_setting.receive_screenshot and 'screenshot_path' in self.loaded_content:
-            screenshot_path = self.loaded_content['screenshot_path']
-            screenshot_segment = MessageSegment.image(
-                file=f'file:///{screenshot_path}')
-            message += str(screenshot_segment)
-        if user_setting.receive_text and 'text' in self.loaded_content:
-            text = self.loaded_content['text']
-            text_segment = MessageSegment.text(text=text)
+        if user_setting.receive_screenshot:
+            screenshot_path = (await self.load_screenshot_and_text()).get('screenshot_path')
+            if screenshot_path is not None:
+                screenshot_segment = MessageSegment.image(
+                    file=f'file:///{screenshot_path}')
+                message += str(screenshot_segment)
+        if user_setting.receive_text:
+            text_segment = MessageSegment.text(text=self.text)
             message += '\n原文：' + str(text_segment)
         if user_setting.receive_translation:
-            await self.load_translation()
-            translation = self.loaded_content['translation']
+            translation = await self.load_translation()
             translation_segment = MessageSegment.text(text=translation)
             message += '\n翻译：' + str(translation_segment)
         if user_setting.receive_content:
-            await self.load_content()
-            media_urls: list[str] = self.loaded_content['content']
+            media_urls = await self.load_content()
             if len(media_urls) != 0:
                 message += '\n附件：'
                 for media_url in media_urls:
                     if media_url is not None:
                         message += str(MessageSegment.image(file=media_url))
-        history_index = await group_setting.add_history(self.tweet_url)
-        message += f'\n编号：{history_index}'
         return message
 
-    async def make_forward_message(self, bot: Bot, group_setting: GroupSetting, user_setting: UserSetting):
+    async def make_normal_message(self, user_setting: UserSetting):
+        # the body only depends on the render profile, only the history number differs between groups
+        return await self.load(f'normal_body_{user_setting.get_render_profile()}',
+                               lambda: self.make_normal_body(user_setting))
+
+    async def make_forward_body(self, bot: Bot, user_setting: UserSetting):
         message = list()
-        if user_setting.receive_screenshot and 'screenshot_path' in self.loaded_content:
-            screenshot_path = self.loaded_content['screenshot_path']
-            screenshot_segment = MessageSegment.image(
-                file=f'file:///{screenshot_path}')
-            screenshot_node = await make_forward_message_node('截图', bot.self_id, screenshot_segment)
-            message.append(screenshot_node)
-        if user_setting.receive_text and 'text' in self.loaded_content:
-            text = self.loaded_content['text']
-            text_segment = MessageSegment.text(text=text)
+        if user_setting.receive_screenshot:
+            screenshot_path = (await self.load_screenshot_and_text()).get('screenshot_path')
+            if screenshot_path is not None:
+                screenshot_segment = MessageSegment.image(
+                    file=f'file:///{screenshot_path}')
+                screenshot_node = await make_forward_message_node('截图', bot.self_id, screenshot_segment)
+                message.append(screenshot_node)
+        if user_setting.receive_text:
+            text_segment = MessageSegment.text(text=self.text)
             text_node = await make_forward_message_node('原文', bot.self_id, text_segment)
             message.append(text_node)
         if user_setting.receive_translation:
-            await self.load_translation()
-            translation = self.loaded_content['translation']
+            translation = await self.load_translation()
             translation_segment = MessageSegment.text(text=translation)
             translation_node = await make_forward_message_node('翻译', bot.self_id, translation_segment)
             message.append(translation_node)
         if user_setting.receive_content:
-            await self.load_content()
-            media_urls: list[str] = self.loaded_content['content']
+            media_urls = await self.load_content()
             for media_url in media_urls:
                 if media_url is not None:
                     message.append(await make_forward_message_node('附件', bot.self_id, MessageSegment.image(file=media_url)))
-        history_index = await group_setting.add_history(self.tweet_url)
-        message.append(await make_forward_message_node('编号', bot.self_id, MessageSegment.text(text=f'编号：{history_index}')))
         return message
 
-    async def send_message(self, bot: Bot, group_setting: GroupSetting):
+    async def make_forward_message(self, bot: Bot, user_setting: UserSetting):
+        return await self.load(f'forward_body_{user_setting.get_render_profile()}_{bot.self_id}',
+                               lambda: self.make_forward_body(bot, user_setting))
+
+    async def make_message(self, bot: Bot, group_setting: GroupSetting):
         nonebot.logger.debug(
             f'making message for group {group_setting.group_id}')
-        await self.load_screenshot_and_text()
+        messages = list()
         user_setting = await group_setting.get_user_setting(user_id=self.user_id)
         if user_setting is None:
-            return
+            return messages
         if not getattr(user_setting, f'receive_{self.tweet_type}'):
-            return
-        if 'screenshot_path' not in self.loaded_content:
-            await send_group_message(bot, group_setting.group_id, self.loaded_content['text'])
-        nonebot.logger.debug(f'user_setting {await user_setting.to_json()}')
+            return messages
+        if user_setting.receive_screenshot:
+            screenshot = await self.load_screenshot_and_text()
+            if 'screenshot_path' not in screenshot:
+                messages.append((False, screenshot['text']))
+        nonebot.logger.debug(
+            f'{user_setting} render profile {user_setting.get_render_profile():#x}')
         if not user_setting.receive_collapsed_message:
-            message = await self.make_normal_message(group_setting, user_setting)
-            await send_group_message(bot, group_setting.group_id, message)
+            messages.append((False, await self.make_normal_message(user_setting)))
         else:
-            messages = await self.make_forward_message(bot, group_setting, user_setting)
-            await send_forward_message(bot, group_setting.group_id, messages)
-        nonebot.logger.debug('send message finished')
+            messages.append((True, await self.make_forward_message(bot, user_setting)))
+        return messages
+
+    async def number_message(self, bot: Bot, group_setting: GroupSetting, messages: list[tuple[bool, str | list]]):
+        # the tweet itself is always the last message
+        if len(messages) == 0:
+            return messages
+        history_index = await group_setting.add_history(self.tweet_url, self.user_id)
+        (collapsed, message) = messages[-1]
+        if collapsed:
+            message = [*message, await make_forward_message_node('编号', bot.self_id, MessageSegment.text(text=f'编号：{history_index}'))]
+        else:
+            message = message + f'\n编号：{history_index}'
+        return [*messages[:-1], (collapsed, message)]
+
+    async def send_prepared_message(self, bot: Bot, group_setting: GroupSetting, messages: list[tuple[bool, str | list]]):
+        screenshot_path = self.get_screenshot_path()
+        files = None if screenshot_path is None else [screenshot_path]
+        for (collapsed, message) in messages:
+            if collapsed:
+                await queue_forward_message(bot, group_setting.group_id, message, files)
+            else:
+                await queue_group_message(bot, group_setting.group_id, message, files)
+        nonebot.logger.debug('send message queued')
 
     async def clean_up(self):
-        screenshot_path = self.loaded_content.get('screenshot_path')
-        if screenshot_path is not None and os.path.exists(screenshot_path):
-            await remove(screenshot_path)
+        screenshot = self.components.get('screenshot')
+        if screenshot is not None and not screenshot.done():
+            await asyncio.wait([screenshot])
+        screenshot_path = self.get_screenshot_path()
+        if screenshot_path is not None:
+            # removed once no queued message points at it any more
+            await send_scheduler.outbox.release_file(screenshot_path)
         nonebot.logger.debug(f'tweet {self.tweet_url} cleaned up')
@@ -0,0 +1,107 @@
+import time
+import heapq
+import asyncio
+import nonebot
+
+from asyncio import Future, Task
+
+from .utils import get_screenshot_and_text
+from ..config import get_config
+
+
+class RenderRequest:
+    url: str
+    priority: int
+    future: Future
+    enqueued_at: float
+    started: bool = False
+
+    def __init__(self, url: str, priority: int) -> None:
+        self.url = url
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {self.url} priority {self.priority}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class RenderQueue:
+    max_concurrency: int
+    queue: list[tuple[int, int, RenderRequest]]
+    in_flight: dict[str, RenderRequest]
+    workers: set[Task]
+    sequence: int = 0
+    rendered: int = 0
+    coalesced: int = 0
+    average_wait: float = 0
+    average_render: float = 0
+
+    def __init__(self) -> None:
+        self.max_concurrency = int(
+            get_config('screenshot_max_concurrency', 2))
+        self.queue = list()
+        self.in_flight = dict()
+        self.workers = set()
+
+    async def submit(self, url: str, priority: int = 0) -> dict[str, str]:
+        request = self.in_flight.get(url)
+        if request is not None:
+            self.coalesced += 1
+            if priority > request.priority and not request.started:
+                # re-queued with the higher priority, the stale heap entry is skipped by the worker
+                request.priority = priority
+                self.push(request)
+        else:
+            request = self.in_flight[url] = RenderRequest(url, priority)
+            self.push(request)
+        # shielded so one cancelled waiter does not cancel the render shared with others
+        return await asyncio.shield(request.future)
+
+    def push(self, request: RenderRequest):
+        # higher priority first, then first come first served
+        self.sequence += 1
+        heapq.heappush(self.queue, (-request.priority, self.sequence, request))
+        if len(self.workers) < self.max_concurrency:
+            self.workers.add(asyncio.create_task(self.work()))
+
+    async def work(self):
+        try:
+            await self.drain()
+        finally:
+            # removed before the task finishes, a done callback would leave a window where push starts no worker
+            self.workers.discard(asyncio.current_task())
+
+    async def drain(self):
+        while len(self.queue) != 0:
+            (_, _, request) = heapq.heappop(self.queue)
+            if request.started:
+                continue
+            request.started = True
+            started_at = time.perf_counter()
+            wait = started_at - request.enqueued_at
+            try:
+                request.future.set_result(await get_screenshot_and_text(request.url))
+            except Exception as e:
+                request.future.set_exception(e)
+            finally:
+                self.in_flight.pop(request.url, None)
+                render = time.perf_counter() - started_at
+                self.rendered += 1
+                self.average_wait = self.average_wait * 0.9 + wait * 0.1
+                self.average_render = self.average_render * 0.9 + render * 0.1
+                nonebot.logger.debug(
+                    f'{self} => {request} waited {wait:.2f}s, rendered in {render:.2f}s')
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} queued {len(self.queue)} in flight {len(self.in_flight)} rendered {self.rendered} ' \
+               f'coalesced {self.coalesced} wait {self.average_wait:.2f}s render {self.average_render:.2f}s]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+render_queue = RenderQueue()
@@ -1,22 +1,50 @@
 import nonebot
 
-from asyncio import Queue
+from asyncio import Queue, Event
 from typing import Union
 from tweepy.asynchronous import AsyncStream
 
 from .models import Tweet
+from .dedup import RecentIds
+from .journal import IngestionJournal
 
 
 class Stream(AsyncStream):
     stream_queue: Queue[tuple[bool, Union[str, Tweet]]]
-    registered_users: list[int]
+    registered_users: frozenset[int] = frozenset()
+    recent_tweet_ids: RecentIds = None
+    journal: IngestionJournal = None
+    connected: Event = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connected = Event()
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def set_registered_users(self, registered_users: frozenset[int]):
+        self.registered_users = frozenset(registered_users)
 
     async def on_status(self, status):
-        tweet = Tweet(status)
-        if tweet.user.id in self.registered_users:
-            nonebot.logger.debug(
-                f'Stream -> received tweet from {tweet.user.screen_name}')
-            await self.stream_queue.put((True, tweet))
+        if status.user.id not in self.registered_users:
+            return
+        if self.recent_tweet_ids is not None and not self.recent_tweet_ids.add(status.id):
+            nonebot.logger.debug(f'Stream -> skipped duplicated tweet {status.id}')
+            return
+        nonebot.logger.debug(
+            f'Stream -> received tweet from {status.user.screen_name}')
+        tweet = Tweet.from_status(status)
+        if self.journal is not None:
+            await self.journal.put(tweet)
+        await self.stream_queue.put((True, tweet))
+
+    async def on_connect(self):
+        nonebot.logger.debug('Stream -> connected')
+        self.connected.set()
+
+    async def on_disconnect(self):
+        self.connected.clear()
 
     async def on_closed(self, resp):
         nonebot.logger.debug('error on_closed')
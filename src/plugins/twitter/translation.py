@@ -0,0 +1,335 @@
+import os
+import re
+import time
+import asyncio
+import sqlite3
+import hashlib
+import nonebot
+
+from asyncio import Future, Task
+from collections import OrderedDict
+
+from .utils import request_translation
+from ..ratelimit import TokenBucket
+from ..config import get_config
+
+
+url_pattern = re.compile(r'https?://\S+')
+# only mentions are dropped, hashtags are usually words of the text itself
+mention_pattern = re.compile(r'@\w+')
+script_patterns = {
+    # kana and the kanji iteration marks only appear in japanese
+    'kana': re.compile(r'[\u3005\u3006\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]'),
+    'hangul': re.compile(r'[\uac00-\ud7af\u1100-\u11ff\u3130-\u318f]'),
+    'han': re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]'),
+    # japanese shinjitai, simplified and traditional chinese both write these differently
+    'shinjitai': re.compile(r'[発売図駅県円広読気歳経様楽薬辺伝覚対戦択鉄転営価検験応関帰権観変実単乗従渋譲嬢済斎'
+                            r'総絵継続緑縁桜黒働込畑峠枠匂拡塩歩毎悪亜圧囲栄駆徳郷隣髪]'),
+    'latin': re.compile(r'[A-Za-z\u00c0-\u024f]'),
+    'letter': re.compile(r'[^\W\d_]')
+}
+
+
+def detect_language(text: str):
+    stripped_text = url_pattern.sub('', text)
+    if stripped_text.strip() == '':
+        return 'url' if text.strip() != '' else 'empty'
+    stripped_text = mention_pattern.sub('', stripped_text)
+    counts = {script: len(pattern.findall(stripped_text))
+              for script, pattern in script_patterns.items()}
+    if counts['letter'] == 0:
+        return 'symbol'
+    if counts['kana'] != 0 or counts['shinjitai'] != 0:
+        return 'jp'
+    if counts['hangul'] != 0:
+        return 'kor'
+    if counts['han'] != 0 and counts['han'] >= counts['latin']:
+        return 'zh'
+    if counts['latin'] != 0:
+        return 'en'
+    return 'auto'
+
+
+class TranslationCache:
+    cache_path: str
+    max_memory_amount: int
+    max_disk_amount: int
+    ttl: float
+
+    memory: OrderedDict[str, tuple[str, float]]
+    connection: sqlite3.Connection = None
+    connection_lock: asyncio.Lock
+    put_amount: int = 0
+
+    hit: int = 0
+    disk_hit: int = 0
+    miss: int = 0
+
+    def __init__(self) -> None:
+        config = nonebot.get_driver().config
+        self.cache_path = os.path.join(config.database_path, 'translation_cache.sqlite3')
+        self.max_memory_amount = int(
+            get_config('translation_cache_memory_amount', 1024))
+        self.max_disk_amount = int(
+            get_config('translation_cache_disk_amount', 50000))
+        self.ttl = float(get_config('translation_cache_ttl', 30 * 24 * 3600))
+        self.memory = OrderedDict()
+        self.connection_lock = asyncio.Lock()
+
+    @staticmethod
+    def make_key(text: str, language: str):
+        normalized_text = re.sub(r'\s+', ' ', text).strip()
+        return hashlib.sha1(f'{language}\n{normalized_text}'.encode('utf-8')).hexdigest()
+
+    async def execute(self, function, *args):
+        async with self.connection_lock:
+            if self.connection is None:
+                self.connection = await asyncio.to_thread(self.connect)
+            return await asyncio.to_thread(function, self.connection, *args)
+
+    def connect(self):
+        connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+        connection.execute('pragma journal_mode=wal')
+        connection.execute('pragma synchronous=normal')
+        connection.executescript(schema)
+        return connection
+
+    async def get(self, text: str, language: str):
+        key = self.make_key(text, language)
+        now = time.time()
+        if key in self.memory:
+            (translation, created_at) = self.memory[key]
+            if now - created_at <= self.ttl:
+                self.memory.move_to_end(key)
+                self.hit += 1
+                return translation
+            self.memory.pop(key)
+        # only the hot entries live in memory, everything else is looked up on disk
+        row = await self.execute(select_translation, key)
+        if row is not None:
+            (translation, created_at) = row
+            if now - created_at <= self.ttl:
+                self.remember(key, translation, created_at)
+                self.disk_hit += 1
+                return translation
+        self.miss += 1
+        return None
+
+    async def put(self, text: str, language: str, translation: str):
+        key = self.make_key(text, language)
+        created_at = time.time()
+        self.remember(key, translation, created_at)
+        await self.execute(insert_translation, key, translation, created_at)
+        self.put_amount += 1
+        if self.put_amount % max(1, self.max_disk_amount // 10) == 0:
+            await self.prune()
+
+    def remember(self, key: str, translation: str, created_at: float):
+        self.memory[key] = (translation, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_amount:
+            self.memory.popitem(last=False)
+
+    async def load(self):
+        await self.prune()
+        nonebot.logger.debug(f'{self} => load completed')
+
+    async def prune(self):
+        await self.execute(delete_stale_translations, time.time() - self.ttl, self.max_disk_amount)
+        nonebot.logger.debug(f'{self} => prune completed')
+
+    async def shutdown(self):
+        if self.connection is not None:
+            async with self.connection_lock:
+                await asyncio.to_thread(self.connection.close)
+                self.connection = None
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} memory {len(self.memory)} hit {self.hit} disk_hit {self.disk_hit} miss {self.miss}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+schema = """
+create table if not exists translation_cache (
+    key text primary key,
+    translation text not null,
+    created_at real not null
+);
+create index if not exists translation_cache_created_at on translation_cache (created_at);
+"""
+
+
+def select_translation(connection: sqlite3.Connection, key: str):
+    return connection.execute('select translation, created_at from translation_cache where key = ?', (key,)).fetchone()
+
+
+def insert_translation(connection: sqlite3.Connection, key: str, translation: str, created_at: float):
+    with connection:
+        connection.execute('insert or replace into translation_cache (key, translation, created_at) values (?, ?, ?)',
+                           (key, translation, created_at))
+
+
+def delete_stale_translations(connection: sqlite3.Connection, deadline: float, max_amount: int):
+    with connection:
+        connection.execute(
+            'delete from translation_cache where created_at < ?', (deadline,))
+        connection.execute('delete from translation_cache where key not in '
+                           '(select key from translation_cache order by created_at desc limit ?)', (max_amount,))
+
+
+class TranslationBatcher:
+    language: str
+    window: float
+    max_query_length: int
+    max_retry_amount: int
+    bucket: TokenBucket
+
+    pending: list[tuple[str, Future]]
+    pending_length: int = 0
+    flush_task: Task = None
+
+    def __init__(self, language: str) -> None:
+        self.language = language
+        self.window = float(get_config('translation_batch_window', 0.5))
+        # utf-8 bytes, the api rejects a q longer than 6000 bytes
+        self.max_query_length = int(
+            get_config('translation_max_query_length', 6000))
+        # the first attempt counts, at least one request is always sent
+        self.max_retry_amount = max(1, int(
+            get_config('translation_max_retry_amount', 3)))
+        self.bucket = TokenBucket(float(get_config('translation_qps', 1)))
+        self.pending = list()
+
+    async def translate(self, text: str):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, future))
+        self.pending_length += self.get_query_length(text)
+        if self.pending_length >= self.max_query_length:
+            self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return await future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        batch = self.pending
+        self.pending = list()
+        self.pending_length = 0
+        for chunk in self.split_batch(batch):
+            asyncio.create_task(self.send_batch(chunk))
+
+    @staticmethod
+    def get_query_length(text: str):
+        # one more byte for the newline joining it to the next text
+        return len(text.encode('utf-8')) + 1
+
+    def split_batch(self, batch: list[tuple[str, Future]]):
+        chunk = list()
+        chunk_length = 0
+        for (text, future) in batch:
+            text_length = self.get_query_length(text)
+            if len(chunk) != 0 and chunk_length + text_length > self.max_query_length:
+                yield chunk
+                chunk = list()
+                chunk_length = 0
+            chunk.append((text, future))
+            chunk_length += text_length
+        if len(chunk) != 0:
+            yield chunk
+
+    async def request(self, query: str):
+        for _ in range(self.max_retry_amount):
+            await self.bucket.acquire()
+            match await request_translation(query, self.language):
+                case(False, message, '54003'):
+                    # over the qps limit, tried again once the bucket has a token
+                    result = (False, message)
+                case(succeeded, content, _):
+                    return succeeded, content
+        return result
+
+    async def send_batch(self, batch: list[tuple[str, Future]]):
+        # the api translates every line separately and skips empty lines
+        texts_lines = [[line for line in text.split('\n') if line.strip() != ''] for (text, _) in batch]
+        query = '\n'.join(line for lines in texts_lines for line in lines)
+        try:
+            match await self.request(query):
+                case(True, translated_lines) if len(translated_lines) == sum(len(lines) for lines in texts_lines):
+                    for ((_, future), lines) in zip(batch, texts_lines):
+                        future.set_result(
+                            (True, '\n'.join(translated_lines[:len(lines)]).strip()))
+                        translated_lines = translated_lines[len(lines):]
+                case(True, _):
+                    nonebot.logger.debug(
+                        f'{self} => line amount mismatch, translating {len(batch)} texts one by one')
+                    for (text, future) in batch:
+                        match await self.request(text):
+                            case(True, translated_lines):
+                                future.set_result((True, '\n'.join(translated_lines).strip()))
+                            case result:
+                                future.set_result(result)
+                case result:
+                    for (_, future) in batch:
+                        future.set_result(result)
+        except Exception as e:
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_result((False, f'其他错误{e}'))
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} pending {len(self.pending)} {self.bucket}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class Translator:
+    language: str = 'zh'
+    cache: TranslationCache
+    batcher: TranslationBatcher
+    skipped: dict[str, int]
+
+    def __init__(self) -> None:
+        self.cache = TranslationCache()
+        self.batcher = TranslationBatcher(self.language)
+        self.skipped = dict()
+
+    async def translate(self, text: str):
+        detected_language = detect_language(text)
+        if detected_language in ('empty', 'url', 'symbol', self.language):
+            self.skipped[detected_language] = self.skipped.get(
+                detected_language, 0) + 1
+            return text.strip()
+        translation = await self.cache.get(text, self.language)
+        if translation is not None:
+            return translation
+        match await self.batcher.translate(text):
+            case(True, translation):
+                await self.cache.put(text, self.language, translation)
+                return translation
+            case(False, message):
+                return message
+
+    async def load(self):
+        await self.cache.load()
+
+    async def shutdown(self):
+        await self.cache.shutdown()
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {self.cache} skipped {self.skipped}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+translator = Translator()
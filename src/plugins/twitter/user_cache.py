@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import aiofiles
+import nonebot
+
+from typing import Any
+
+from ..config import get_config
+
+
+class TwitterUser:
+    id: int
+    screen_name: str
+    name: str
+    fetched_at: float
+
+    def __init__(self, id: int, screen_name: str, name: str = '', fetched_at: float = None) -> None:
+        self.id = id
+        self.screen_name = screen_name
+        self.name = name
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    async def to_json(self):
+        return {
+            'id': self.id,
+            'screen_name': self.screen_name,
+            'name': self.name,
+            'fetched_at': self.fetched_at
+        }
+
+    @staticmethod
+    async def from_json(json_content: dict[str, Any]):
+        match json_content:
+            case {'id': int(user_id), 'screen_name': str(screen_name), 'fetched_at': int(fetched_at) | float(fetched_at)}:
+                return TwitterUser(user_id, screen_name, json_content.get('name', ''), fetched_at)
+            case _:
+                return None
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {self.screen_name}]'
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class UserCache:
+    cache_path: str
+    ttl: float
+    users: dict[str, TwitterUser]
+
+    def __init__(self) -> None:
+        config = nonebot.get_driver().config
+        self.cache_path = os.path.join(config.database_path, 'user_cache.json')
+        self.ttl = float(get_config('twitter_user_cache_ttl', 7 * 24 * 3600))
+        self.users = dict()
+
+    async def get(self, screen_name: str):
+        user = self.users.get(screen_name.lower())
+        if user is None:
+            return None
+        if time.time() - user.fetched_at > self.ttl:
+            self.users.pop(screen_name.lower())
+            return None
+        return user
+
+    async def put(self, user: TwitterUser):
+        self.users[user.screen_name.lower()] = user
+
+    async def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        async with aiofiles.open(self.cache_path, 'r', encoding='utf-8') as f:
+            json_content: dict = json.loads(await f.read())
+        now = time.time()
+        for user_json_content in json_content.values():
+            user = await TwitterUser.from_json(user_json_content)
+            if user is not None and now - user.fetched_at <= self.ttl:
+                await self.put(user)
+        nonebot.logger.debug(f'{self} => load completed')
+
+    async def save(self):
+        cache_content = {key: await user.to_json() for key, user in self.users.items()}
+        async with aiofiles.open(self.cache_path, 'w', encoding='utf-8') as f:
+            await f.write(json.dumps(cache_content, ensure_ascii=False, indent=4))
+        nonebot.logger.debug(f'{self} => save completed')
+
+    def __str__(self) -> str:
+        return f'[{type(self).__name__} {len(self.users)}]'
+
+    def __repr__(self) -> str:
+        return str(self)
@@ -1,8 +1,6 @@
-import aiohttp
 import nonebot
 import random
 import hashlib
-import urllib
 
 from nonebot.plugin import require
 from nonebot.adapters.cqhttp import MessageSegment
@@ -10,70 +8,85 @@ from nonebot.adapters.cqhttp import MessageSegment
 from aiohttp.client_exceptions import ClientError
 
 from ..external import ExternalHolder
+from ..network import SessionPool
+from ..config import get_config
 
 
 external = require('external')
 external_holder: ExternalHolder = external.external_holder
+network = require('network')
+session_pool: SessionPool = network.session_pool
 
 
-async def get_screenshot_and_text(url: str, loaded_content: dict):
+async def get_screenshot_and_text(url: str):
+    loaded_content = dict()
     config = nonebot.get_driver().config
     server_url: str = config.server_url
     server_path: str = config.server_path
+    # held while the server is restarting instead of failing right away
+    if not await external_holder.server.wait_ready(float(get_config('screenshot_hold_timeout', 180))):
+        loaded_content['text'] = '截图服务器重启中，请稍后再试'
+        return loaded_content
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{server_url}/screenshot', json={'url': url}) as response:
-                if response.status != 200:
-                    loaded_content['text'] = f'请求失败{response.status}，请联系管理员'
-                else:
-                    server_response: dict = await response.json(encoding='utf-8')
-                    match server_response:
-                        case {'type': 'err', 'message': err_message}:
-                            loaded_content['text'] = err_message
-                        case {'type': 'ok', 'screenshotPath': screenshot_path, 'text': text}:
-                            loaded_content['screenshot_path'] = f'{server_path}\\{screenshot_path}'
-                            loaded_content['text'] = text
-                        case _:
-                            loaded_content['text'] = f'未知服务端响应{response}'
+        async with session_pool.get('screenshot', f'{server_url}/screenshot', json={'url': url}) as response:
+            if response.status != 200:
+                loaded_content['text'] = f'请求失败{response.status}，请联系管理员'
+            else:
+                server_response: dict = await response.json(encoding='utf-8')
+                match server_response:
+                    case {'type': 'err', 'message': err_message}:
+                        loaded_content['text'] = err_message
+                    case {'type': 'ok', 'screenshotPath': screenshot_path, 'text': text}:
+                        loaded_content['screenshot_path'] = f'{server_path}\\{screenshot_path}'
+                        loaded_content['text'] = text
+                    case _:
+                        loaded_content['text'] = f'未知服务端响应{response}'
     except ClientError as e:
-        await external_holder.reboot_server()
+        external_holder.server.request_probe()
         loaded_content['text'] = f'服务器请求失败{e}'
     except Exception as e:
         loaded_content['text'] = f'其他错误{e}'
+    return loaded_content
 
 
-async def get_translation(text: str, loaded_content: dict):
+async def request_translation(query: str, language: str = 'zh'):
     config = nonebot.get_driver().config
     translate_url = config.translate_url
     translate_appid = config.baidu_appid
     translate_secret = config.baidu_secret
     salt = random.randint(32768, 65536)
-    sign = f'{translate_appid}{text}{salt}{translate_secret}'.encode('utf-8')
+    sign = f'{translate_appid}{query}{salt}{translate_secret}'.encode('utf-8')
     md5_module = hashlib.md5()
     md5_module.update(sign)
     new_sign = md5_module.hexdigest()
-    request_url = f'{translate_url}?q={urllib.parse.quote(text)}' \
-                  f'&from=auto&to=zh&appid={translate_appid}&salt={salt}&sign={new_sign}'
+    # batched queries are too long for a query string, the api takes the same fields as a form
+    form = {'q': query, 'from': 'auto', 'to': language,
+            'appid': translate_appid, 'salt': salt, 'sign': new_sign}
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(request_url) as response:
-                if response.status != 200:
-                    loaded_content['translation'] = f'翻译请求失败{response.status}'
+        async with session_pool.post('translate', translate_url, data=form) as response:
+            if response.status != 200:
+                return False, f'翻译请求失败{response.status}', None
+            else:
+                server_response: dict = await response.json(encoding='utf-8')
+                if 'error_code' in server_response:
+                    error_code = str(server_response['error_code'])
+                    return False, f'翻译请求失败{error_code}', error_code
                 else:
-                    server_response: dict = await response.json(encoding='utf-8')
-                    if 'error_code' in server_response:
-                        loaded_content['translation'] = f'翻译请求失败{server_response["error_code"]}'
-                    else:
-                        translated_text = ''
-                        translated_results: list[dict[str, str]] = server_response.get(
-                            'trans_result')
-                        for translated_result in translated_results:
-                            translated_text += translated_result['dst'] + '\n'
-                        loaded_content['translation'] = translated_text.strip()
+                    translated_results: list[dict[str, str]] = server_response.get(
+                        'trans_result')
+                    return True, [translated_result['dst'] for translated_result in translated_results], None
     except ClientError as e:
-        loaded_content['translation'] = f'服务器请求失败{e}'
+        return False, f'服务器请求失败{e}', None
     except Exception as e:
-        loaded_content['translation'] = f'其他错误{e}'
+        return False, f'其他错误{e}', None
+
+
+def get_status_text(status) -> str:
+    status = getattr(status, 'retweeted_status', status)
+    extended_tweet: dict = getattr(status, 'extended_tweet', None)
+    if extended_tweet is not None and 'full_text' in extended_tweet:
+        return extended_tweet['full_text']
+    return getattr(status, 'full_text', None) or getattr(status, 'text', '')
 
 
 async def make_forward_message_node(nickname: str, user_id: str, content: MessageSegment | str):